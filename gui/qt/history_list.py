@@ -49,10 +49,16 @@ TX_ICONS = [
 
 class HistoryList(MyTreeWidget):
 
+    # number of items fetched at a time, more are fetched on scroll
+    page_size = 200
+
     def __init__(self, parent=None):
         MyTreeWidget.__init__(self, parent, self.create_menu, [], 3)
         self.refresh_headers()
         self.setColumnHidden(1, True)
+        self.loaded = 0
+        self.complete = True
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
 
     def refresh_headers(self):
         headers = ['', '', _('Date'), _('Description') , _('Amount'), _('Balance')]
@@ -60,17 +66,33 @@ class HistoryList(MyTreeWidget):
         self.update_headers(headers)
 
     def get_domain(self):
-        '''Replaced in address_dialog.py'''
+        '''Replaced in address_dialog.py.  None is the whole wallet,
+        whose history pages are read without scanning its addresses.'''
+        if self.parent.current_account is None:
+            return None
         return self.wallet.get_account_addresses(self.parent.current_account)
 
     def on_update(self):
         self.wallet = self.parent.wallet
-        h = self.wallet.get_history(self.get_domain())
         item = self.currentItem()
         current_tx = item.data(0, Qt.UserRole).toString() if item else None
+        # keep as many items as were shown before the update
+        count = max(self.page_size, self.loaded)
         self.clear()
+        self.loaded = 0
         run_hook('history_tab_update_begin')
-        for h_item in h:
+        self.load_page(count, current_tx)
+
+    def on_scroll(self, value):
+        if not self.complete and value == self.verticalScrollBar().maximum():
+            self.load_page(self.page_size)
+
+    def load_page(self, count, current_tx=None):
+        '''Append the count most recent items not shown yet'''
+        h = self.wallet.get_history(self.get_domain(), offset=self.loaded, count=count)
+        self.loaded += len(h)
+        self.complete = len(h) < count
+        for h_item in reversed(h):
             tx_hash, height, conf, timestamp, value, balance = h_item
             status, status_str = self.wallet.get_tx_status(tx_hash, height, conf, timestamp)
             icon = QIcon(":icons/" + TX_ICONS[status])
@@ -91,7 +113,7 @@ class HistoryList(MyTreeWidget):
                 item.setForeground(4, QBrush(QColor("#BC1E1E")))
             if tx_hash:
                 item.setData(0, Qt.UserRole, tx_hash)
-            self.insertTopLevelItem(0, item)
+            self.addTopLevelItem(item)
             if current_tx == tx_hash:
                 self.setCurrentItem(item)
 
@@ -23,12 +23,18 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from bisect import bisect_left, insort
+
 import bitcoin
+import ecc
 from bitcoin import *
 from i18n import _
 from transaction import Transaction, is_extended_pubkey
 from util import InvalidPassword
 
+# below this many keys, forking a pool costs more than it saves
+PARALLEL_DERIVATION_MIN = 100
+
 
 class Account(object):
     def __init__(self, v):
@@ -37,6 +43,19 @@ class Account(object):
         # addresses will not be stored on disk
         self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
         self.change_addresses    = map(self.pubkeys_to_address, self.change_pubkeys)
+        self.index_addresses()
+
+    def index_addresses(self):
+        # address -> (for_change, n)
+        self.address_index = {}
+        for for_change in [0, 1]:
+            addr_list = self.change_addresses if for_change else self.receiving_addresses
+            for n, address in enumerate(addr_list):
+                self.address_index.setdefault(address, (for_change, n))
+
+    def get_address_index(self, address):
+        "Returns (for_change, n), or None if the address is not in the account"
+        return self.address_index.get(address)
 
     def dump(self):
         return {'receiving':self.receiving_pubkeys, 'change':self.change_pubkeys}
@@ -59,15 +78,37 @@ class Account(object):
     def derive_pubkeys(self, for_change, n):
         pass
 
+    def derive_range(self, for_change, start, count, pool=None):
+        "Returns the pubkeys of addresses start to start + count - 1"
+        return [self.derive_pubkeys(for_change, n) for n in range(start, start + count)]
+
     def create_new_address(self, for_change):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count, pool=None):
         pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        n = len(pubkeys_list)
-        pubkeys = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(pubkeys)
-        pubkeys_list.append(pubkeys)
-        addr_list.append(address)
-        return address
+        start = len(pubkeys_list)
+        pubkeys_range = self.derive_range(for_change, start, count, pool)
+        out = []
+        for n, pubkeys in enumerate(pubkeys_range, start):
+            address = self.pubkeys_to_address(pubkeys)
+            pubkeys_list.append(pubkeys)
+            addr_list.append(address)
+            self.address_index.setdefault(address, (for_change, n))
+            out.append(address)
+        return out
+
+    def remove_addresses(self, for_change, count):
+        "Forget the last count addresses of a sequence, and return them"
+        pubkeys_list = self.change_pubkeys if for_change else self.receiving_pubkeys
+        addr_list = self.change_addresses if for_change else self.receiving_addresses
+        n = len(addr_list) - count
+        removed = addr_list[n:]
+        del pubkeys_list[n:]
+        del addr_list[n:]
+        self.index_addresses()
+        return removed
 
     def pubkeys_to_address(self, pubkey):
         return public_key_to_bc_address(pubkey.decode('hex'))
@@ -87,17 +128,27 @@ class Account(object):
 
     def synchronize_sequence(self, wallet, for_change):
         limit = wallet.gap_limit_for_change if for_change else wallet.gap_limit
-        while True:
-            addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
+        # while restoring, keep a whole window of addresses ahead of the
+        # last used one, so that their histories are requested together
+        restoring = bool(wallet.restore_window)
+        if restoring:
+            limit = max(limit, wallet.restore_window)
+            # any history counts, as in wallet.finish_restore, which
+            # waits for the window to follow the last used address
+            is_used = lambda a: bool(wallet.history.get(a))
+        else:
+            is_used = wallet.address_is_old
+        addresses = self.get_addresses(for_change)
+        # the last limit addresses must be unused
+        unused = 0
+        for a in addresses[::-1][:limit]:
+            if is_used(a):
                 break
-            else:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
+            unused += 1
+        if unused < limit:
+            pool = wallet.restore_pool if restoring else None
+            new_addresses = self.create_new_addresses(for_change, limit - unused, pool)
+            wallet.add_addresses(new_addresses)
 
     def synchronize(self, wallet):
         self.synchronize_sequence(wallet, False)
@@ -107,17 +158,28 @@ class Account(object):
 class ImportedAccount(Account):
     def __init__(self, d):
         self.keypairs = d['imported']
+        self.index_addresses()
+
+    def index_addresses(self):
+        # n is the position of an address in the sorted list, which is
+        # kept up to date as keys are imported and removed
+        self.sorted_addresses = sorted(self.keypairs.keys())
+
+    def get_address_index(self, address):
+        if address not in self.keypairs:
+            return None
+        return 0, bisect_left(self.sorted_addresses, address)
 
     def synchronize(self, wallet):
         return
 
     def get_addresses(self, for_change):
-        return [] if for_change else sorted(self.keypairs.keys())
+        return [] if for_change else list(self.sorted_addresses)
 
     def get_pubkey(self, *sequence):
         for_change, i = sequence
         assert for_change == 0
-        addr = self.get_addresses(0)[i]
+        addr = self.sorted_addresses[i]
         return self.keypairs[addr][0]
 
     def get_xpubkeys(self, for_change, n):
@@ -127,7 +189,7 @@ class ImportedAccount(Account):
         from wallet import pw_decode
         for_change, i = sequence
         assert for_change == 0
-        address = self.get_addresses(0)[i]
+        address = self.sorted_addresses[i]
         pk = pw_decode(self.keypairs[address][1], password)
         # this checks the password
         if address != address_from_private_key(pk):
@@ -139,10 +201,13 @@ class ImportedAccount(Account):
 
     def add(self, address, pubkey, privkey, password):
         from wallet import pw_encode
+        if address not in self.keypairs:
+            insort(self.sorted_addresses, address)
         self.keypairs[address] = [pubkey, pw_encode(privkey, password)]
 
     def remove(self, address):
         self.keypairs.pop(address)
+        del self.sorted_addresses[bisect_left(self.sorted_addresses, address)]
 
     def dump(self):
         return {'imported':self.keypairs}
@@ -191,10 +256,8 @@ class OldAccount(Account):
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(mpk, curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + public_key2.to_string().encode('hex')
+        pubkey_point = ecc.add(ecc.ser_to_point('\x04' + mpk), ecc.mul_G(z))
+        return ecc.point_to_ser(pubkey_point, False).encode('hex')
 
     def derive_pubkeys(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
@@ -207,19 +270,24 @@ class OldAccount(Account):
         return SecretToASecret( pk, compressed )
 
 
-    def get_private_key(self, sequence, wallet, password):
-        seed = wallet.get_seed(password)
-        self.check_seed(seed)
+    def get_private_key(self, sequence, wallet, password, secexp=None):
+        if secexp is None:
+            secexp = self.get_master_secret(wallet, password)
         for_change, n = sequence
-        secexp = self.stretch_key(seed)
         pk = self.get_private_key_from_stretched_exponent(for_change, n, secexp)
         return [pk]
 
+    def get_master_secret(self, wallet, password):
+        "Returns the stretched seed, after checking it against the mpk"
+        secexp = self.stretch_key(wallet.get_seed(password))
+        self.check_stretched_key(secexp)
+        return secexp
 
     def check_seed(self, seed):
-        secexp = self.stretch_key(seed)
-        master_private_key = ecdsa.SigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-        master_public_key = master_private_key.get_verifying_key().to_string()
+        return self.check_stretched_key(self.stretch_key(seed))
+
+    def check_stretched_key(self, secexp):
+        master_public_key = ecc.point_to_ser(ecc.mul_G(secexp), False)[1:]
         if master_public_key != self.mpk:
             print_error('invalid password (mpk)', self.mpk.encode('hex'), master_public_key.encode('hex'))
             raise InvalidPassword()
@@ -252,13 +320,36 @@ class OldAccount(Account):
         return mpk, s
 
 
+def derive_child_pubkeys(c, cK, start, count):
+    "hex pubkeys of children start to start + count - 1 of a branch key"
+    return [CKD_pub(cK, c, n)[0].encode('hex') for n in range(start, start + count)]
+
+
+def _derive_child_pubkeys(args):
+    return derive_child_pubkeys(*args)
+
+
+def derive_range_parallel(c, cK, start, count, pool):
+    """Like derive_child_pubkeys, split in contiguous chunks over the
+    processes of a multiprocessing pool.  The pool is owned by the
+    caller, who must create it before starting any thread: forking a
+    process with threads is not safe on every platform."""
+    import multiprocessing
+    n = min(multiprocessing.cpu_count(), count)
+    size = (count + n - 1) / n
+    chunks = [(c, cK, i, min(size, start + count - i))
+              for i in range(start, start + count, size)]
+    results = pool.map(_derive_child_pubkeys, chunks)
+    return sum(results, [])
+
+
 class BIP32_Account(Account):
 
     def __init__(self, v):
         Account.__init__(self, v)
         self.xpub = v['xpub']
-        self.xpub_receive = None
-        self.xpub_change = None
+        # (xpub, for_change) -> (c, cK) of the branch
+        self.branches = {}
 
     def dump(self):
         d = Account.dump(self)
@@ -286,18 +377,29 @@ class BIP32_Account(Account):
         pubkeys = self.get_pubkeys(for_change, n)
         return pubkeys[i]
 
+    def get_branch(self, xpub, for_change):
+        key = (xpub, for_change)
+        branch = self.branches.get(key)
+        if branch is None:
+            _, _, _, c, cK = deserialize_xkey(xpub)
+            cK, c = CKD_pub(cK, c, for_change)
+            branch = self.branches[key] = c, cK
+        return branch
+
+    def derive_range_from_xpub(self, xpub, for_change, start, count, pool=None):
+        c, cK = self.get_branch(xpub, for_change)
+        if pool is not None and count >= PARALLEL_DERIVATION_MIN:
+            try:
+                return derive_range_parallel(c, cK, start, count, pool)
+            except Exception as e:
+                print_error("parallel derivation failed:", e)
+        return derive_child_pubkeys(c, cK, start, count)
+
+    def derive_range(self, for_change, start, count, pool=None):
+        return self.derive_range_from_xpub(self.xpub, for_change, start, count, pool)
+
     def derive_pubkeys(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        _, _, _, c, cK = deserialize_xkey(xpub)
-        cK, c = CKD_pub(cK, c, n)
-        result = cK.encode('hex')
-        return result
+        return self.derive_range(for_change, n, 1)[0]
 
 
     def get_private_key(self, sequence, wallet, password):
@@ -349,6 +451,7 @@ class Multisig_Account(BIP32_Account):
         self.m = v.get('m', 2)
         Account.__init__(self, v)
         self.xpub_list = v['xpubs']
+        self.branches = {}
 
     def dump(self):
         d = Account.dump(self)
@@ -359,8 +462,10 @@ class Multisig_Account(BIP32_Account):
     def get_pubkeys(self, for_change, n):
         return self.get_pubkey(for_change, n)
 
-    def derive_pubkeys(self, for_change, n):
-        return map(lambda x: self.derive_pubkey_from_xpub(x, for_change, n), self.get_master_pubkeys())
+    def derive_range(self, for_change, start, count, pool=None):
+        ranges = [self.derive_range_from_xpub(xpub, for_change, start, count, pool)
+                  for xpub in self.get_master_pubkeys()]
+        return map(list, zip(*ranges))
 
     def redeem_script(self, for_change, n):
         pubkeys = self.get_pubkeys(for_change, n)
@@ -42,6 +42,7 @@ class BaseWizard(object):
         self.storage = WalletStorage(path)
         self.wallet = None
         self.stack = []
+        self.restoring = False
 
     def run(self, *args):
         action = args[0]
@@ -145,6 +146,7 @@ class BaseWizard(object):
 
     def restore_seed(self):
         # TODO: return derivation password too
+        self.restoring = True
         self.restore_seed_dialog(run_next=self.add_password, is_valid=Wallet.is_seed)
 
     def on_restore(self, text):
@@ -154,6 +156,7 @@ class BaseWizard(object):
             self.create_wallet(text, None)
 
     def restore_from_key(self):
+        self.restoring = True
         if self.wallet_type == 'standard':
             v = is_any_key
             title = _("Import keys")
@@ -253,6 +256,10 @@ class BaseWizard(object):
     def create_addresses(self):
         def task():
             self.wallet.create_main_account()
+            if self.restoring and self.wallet.is_deterministic():
+                # no pool: forking now would copy the running network
+                # and GUI threads
+                self.wallet.start_restore()
             self.wallet.synchronize()
             self.wallet.storage.write()
             self.terminate()
@@ -29,12 +29,15 @@ import base64
 import os
 import re
 import hmac
+import threading
+from collections import OrderedDict
 
 import version
 from util import print_error, InvalidPassword
 
 import ecdsa
 import aes
+import ecc
 
 ################################## transactions
 
@@ -239,27 +242,32 @@ __b43chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
 
+# digits are converted in groups of 10, so that the inner loops only
+# handle machine-sized integers
+__digit_groups = dict((base, base ** 10) for base in (58, 43))
+__digit_values = dict((base, [chars.find(chr(i)) for i in range(256)])
+                      for base, chars in ((58, __b58chars), (43, __b43chars)))
+
 def base_encode(v, base):
     """ encode v, which is a string of bytes, to base58."""
     if base == 58:
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-    result = ''
-    while long_value >= base:
-        div, mod = divmod(long_value, base)
-        result = chars[mod] + result
-        long_value = div
-    result = chars[long_value] + result
+    group = __digit_groups[base]
+    long_value = long(v.encode('hex') or '0', 16)
+    digits = []
+    while long_value:
+        long_value, n = divmod(long_value, group)
+        n = int(n)
+        for i in range(10):
+            n, mod = divmod(n, base)
+            digits.append(chars[mod])
+    # strip the zeros of the last group, keep at least one digit
+    result = ''.join(reversed(digits)).lstrip(chars[0]) or chars[0]
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    nPad = len(v) - len(v.lstrip('\0'))
     return (chars[0]*nPad) + result
 
 
@@ -269,31 +277,60 @@ def base_decode(v, length, base):
         chars = __b58chars
     elif base == 43:
         chars = __b43chars
+    values = __digit_values[base]
     long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += chars.find(c) * (base**i)
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-    nPad = 0
-    for c in v:
-        if c == chars[0]: nPad += 1
-        else: break
+    for i in range(0, len(v), 10):
+        n = 0
+        for c in v[i:i+10]:
+            n = n * base + values[ord(c)]
+        long_value = long_value * base ** len(v[i:i+10]) + n
+    if long_value < 0:
+        raise ValueError('invalid base%d string' % base)
+    h = '%x' % long_value
+    result = ('0' * (len(h) & 1) + h).decode('hex')
+    nPad = len(v) - len(v.lstrip(chars[0]))
     result = chr(0)*nPad + result
     if length is not None and len(result) != length:
         return None
     return result
 
 
+# Extended public keys are encoded and decoded over and over, for every
+# address of their account.  Keep the most recently used ones.
+XPUB_CACHE_SIZE = 64
+xpub_cache = OrderedDict()    # base58 -> payload, and payload -> base58
+xpub_cache_lock = threading.Lock()
+
+def get_cached_xpub(k):
+    with xpub_cache_lock:
+        v = xpub_cache.pop(k, None)
+        if v is not None:
+            xpub_cache[k] = v
+        return v
+
+def cache_xpub(payload, s):
+    if len(payload) != 78 or payload[0:4].encode('hex') not in (BITCOIN_HEADER_PUB, TESTNET_HEADER_PUB):
+        return
+    with xpub_cache_lock:
+        xpub_cache[payload] = s
+        xpub_cache[s] = payload
+        while len(xpub_cache) > 2 * XPUB_CACHE_SIZE:
+            xpub_cache.popitem(last=False)
+
+
 def EncodeBase58Check(vchIn):
-    hash = Hash(vchIn)
-    return base_encode(vchIn + hash[0:4], base=58)
+    s = get_cached_xpub(vchIn)
+    if s is None:
+        hash = Hash(vchIn)
+        s = base_encode(vchIn + hash[0:4], base=58)
+        cache_xpub(vchIn, s)
+    return s
 
 
 def DecodeBase58Check(psz):
+    key = get_cached_xpub(psz)
+    if key is not None:
+        return key
     vchRet = base_decode(psz, None, base=58)
     key = vchRet[0:-4]
     csum = vchRet[-4:]
@@ -302,6 +339,7 @@ def DecodeBase58Check(psz):
     if cs32 != csum:
         return None
     else:
+        cache_xpub(key, psz)
         return key
 
 
@@ -469,28 +507,11 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
     @classmethod
     def from_signature(klass, sig, recid, h, curve):
         """ See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 """
-        from ecdsa import util, numbertheory
-        import msqr
-        curveFp = curve.curve
-        G = curve.generator
-        order = G.order()
-        # extract r,s from signature
-        r, s = util.sigdecode_string(sig, order)
-        # 1.1
-        x = r + (recid/2) * order
-        # 1.3
-        alpha = ( x * x * x  + curveFp.a() * x + curveFp.b() ) % curveFp.p()
-        beta = msqr.modular_sqrt(alpha, curveFp.p())
-        y = beta if (beta - recid) % 2 == 0 else curveFp.p() - beta
-        # 1.4 the constructor checks that nR is at infinity
-        R = Point(curveFp, x, y, order)
-        # 1.5 compute e from message:
-        e = string_to_number(h)
-        minus_e = -e % order
-        # 1.6 compute Q = r^-1 (sR - eG)
-        inv_r = numbertheory.inverse_mod(r,order)
-        Q = inv_r * ( s * R + minus_e * G )
-        return klass.from_public_point( Q, curve )
+        order = curve.generator.order()
+        r, s = ecdsa.util.sigdecode_string(sig, order)
+        x, y = ecc.recover(string_to_number(h), r, s, recid)
+        # no order: ecdsa would check it with a point multiplication
+        return klass.from_public_point( Point(curve.curve, x, y), curve )
 
 
 class MySigningKey(ecdsa.SigningKey):
@@ -500,7 +521,13 @@ class MySigningKey(ecdsa.SigningKey):
         curve = SECP256k1
         G = curve.generator
         order = G.order()
-        r, s = ecdsa.SigningKey.sign_number(self, number, entropy, k)
+        if k is None:
+            k = ecdsa.util.randrange(order, entropy)
+        # r, s as computed by ecdsa, with the faster point multiplication
+        r = ecc.mul_G(k)[0] % order
+        s = ecc.inverse(k, order) * (number + self.privkey.secret_multiplier * r) % order
+        if r == 0 or s == 0:
+            raise ecdsa.keys.RSZeroError("amazingly unlucky random number")
         if s > order/2:
             s = order - s
         return r, s
@@ -510,7 +537,9 @@ class EC_KEY(object):
 
     def __init__( self, k ):
         secret = string_to_number(k)
-        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, generator_secp256k1 * secret )
+        x, y = ecc.mul_G(secret)
+        point = Point( curve_secp256k1, x, y )
+        self.pubkey = ecdsa.ecdsa.Public_key( generator_secp256k1, point )
         self.privkey = ecdsa.ecdsa.Private_key( self.pubkey, secret )
         self.secret = secret
 
@@ -551,10 +580,13 @@ class EC_KEY(object):
         recid = nV - 27
 
         h = Hash(msg_magic(message))
-        public_key = MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1)
+        r, s = ecdsa.util.sigdecode_string(sig[1:], ecc.N)
+        z = string_to_number(h)
+        Q = ecc.recover(z, r, s, recid)
         # check public key
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
+        if not ecc.verify(Q, z, r, s):
+            raise Exception("Bad signature")
+        pubkey = ecc.point_to_ser(Q, compressed)
         # check that we get the original signing address
         addr = public_key_to_bc_address(pubkey)
         if address != addr:
@@ -623,10 +655,9 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    point = ecc.mul_G(string_to_number(secret))
+    K = ecc.point_to_ser(point, False)[1:]
+    K_compressed = ecc.point_to_ser(point, True)
     return K, K_compressed
 
 
@@ -666,11 +697,9 @@ def CKD_pub(cK, c, n):
 def _CKD_pub(cK, c, s):
     order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    pubkey_point = ecc.add(ecc.ser_to_point(cK), ecc.mul_G(string_to_number(I[0:32])))
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
+    cK_n = ecc.point_to_ser(pubkey_point, True)
     return cK_n, c_n
 
 
@@ -26,11 +26,38 @@
 
 
 import os
+import mmap
+import struct
+import threading
+
 import util
 from bitcoin import *
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
+# (height, block hash), from Bitcoin Core.  Below the last checkpoint,
+# the difficulty of headers is not checked, and they are only stored
+# once they lead to one of these hashes.  The headers themselves are
+# still downloaded, since transactions are verified against them.
+# There are no bits here: a retarget needs the timestamps of the period
+# before it, so get_target reads the headers of that period, from the
+# headers file or from the unconfirmed ones.
+CHECKPOINTS = [
+    (11111, '0000000069e244f73d78e8fd29ba2fd2ed618bd6fa2ee92559f542fdb26e7c1d'),
+    (33333, '000000002dd5588a74784eaa7ab0507a18ad16a236e7b1ce69f00d7ddfb5d0a6'),
+    (74000, '0000000000573993a3c9e41ce34471c079dcf5f52a0e824a81e7f953b8661a20'),
+    (105000, '00000000000291ce28027faea320c8d2b054b2e0fe44a773f3eefb151d6bdc97'),
+    (134444, '00000000000005b12ffd4cd315cd34ffd4a594f430ac814c91184a0d42d2b0fe'),
+    (168000, '000000000000099e61ea72015e79632f216fe6cb33d7899acb35b75c8303b763'),
+    (193000, '000000000000059f452a5f7340de6682a977387c17010ff6e6c3bd83ca8b1317'),
+    (210000, '000000000000048b95347e83192f69cf0366076336c639f9b7228e9ba171342e'),
+    (216116, '00000000000001b4f4b433e81ee46494af945cf96014816a4e2370f11b23df4e'),
+    (225430, '00000000000001c108384350f74090433e7fcf79a606b8e797f065b130575932'),
+    (250000, '000000000000003887df1f29024b06fc2200b55f8af8f35453d7be294df2d214'),
+    (279000, '0000000000000001ae8c72a0b0c301f67e3afca10e819efa9041e458e9bd7e40'),
+    (295000, '00000000000000004d9b4ef50f0f9d686fd69db2e03af35a100370c64632a983'),
+]
+
 class Blockchain(util.PrintError):
     '''Manages blockchain headers and their verification'''
     def __init__(self, config, network):
@@ -38,6 +65,15 @@ class Blockchain(util.PrintError):
         self.network = network
         self.headers_url = "https://headers.electrum.org/blockchain_headers"
         self.local_height = 0
+        # the headers file, mapped in memory; None if it is empty
+        self.headers = None
+        self.headers_lock = threading.Lock()
+        # verified headers below the last checkpoint that do not lead
+        # to a checkpoint yet, from unconfirmed_height on.  They replace
+        # the stored headers from that height once they do.
+        self.unconfirmed = ''
+        self.unconfirmed_height = 0
+        self.open_headers()
         self.set_local_height()
 
     def height(self):
@@ -45,6 +81,7 @@ class Blockchain(util.PrintError):
 
     def init(self):
         self.init_headers_file()
+        self.open_headers()
         self.set_local_height()
         self.print_error("%d blocks" % self.local_height)
 
@@ -58,23 +95,65 @@ class Blockchain(util.PrintError):
     def verify_chain(self, chain):
         first_header = chain[0]
         prev_header = self.read_header(first_header.get('block_height') - 1)
+        index = None
         for header in chain:
             height = header.get('block_height')
-            bits, target = self.get_target(height / 2016, chain)
+            if height / 2016 != index:
+                index = height / 2016
+                bits, target = self.get_target(index, chain)
             self.verify_header(header, prev_header, bits, target)
             prev_header = header
 
     def verify_chunk(self, index, data):
+        '''Returns the number of headers of the chunk that can be
+        stored: those up to the last checkpoint of the chunk, and the
+        ones above the last checkpoint.'''
         num = len(data) / 80
-        prev_header = None
+        prev_hash = '\0' * 32
         if index != 0:
-            prev_header = self.read_header(index*2016 - 1)
+            prev_hash = Hash(self.read_unconfirmed_header(index*2016 - 1))
+        # headers up to the last checkpoint are pinned by its hash
+        pinned = max(0, min(num, CHECKPOINTS[-1][0] + 1 - index * 2016))
+        prev_hash, confirmed = self.verify_checkpointed_chunk(index, data[:pinned * 80], prev_hash)
+        if pinned == num:
+            return confirmed
         bits, target = self.get_target(index)
-        for i in range(num):
+        for i in range(pinned, num):
             raw_header = data[i*80:(i+1) * 80]
-            header = self.deserialize_header(raw_header)
-            self.verify_header(header, prev_header, bits, target)
-            prev_header = header
+            prev_hash = self.verify_raw_header(raw_header, prev_hash, bits, target)
+        return num
+
+    def verify_checkpointed_chunk(self, index, data, prev_hash):
+        '''Headers below the last checkpoint are checked for linkage,
+        and for proof of work against their own bits, without
+        recomputing the difficulty.  Returns the hash of the last
+        header, and the number of headers up to the last checkpoint
+        they contain.'''
+        checkpoints = dict(CHECKPOINTS)
+        confirmed = 0
+        for i in range(len(data) / 80):
+            raw_header = data[i*80:(i+1) * 80]
+            bits = struct.unpack_from('<I', raw_header, 72)[0]
+            target = self.bits_to_target(bits)
+            assert target <= MAX_TARGET, "target too high: %s" % target
+            prev_hash = self.verify_raw_header(raw_header, prev_hash, bits, target)
+            height = index * 2016 + i
+            if height in checkpoints:
+                _hash = hash_encode(prev_hash)
+                assert _hash == checkpoints[height], "checkpoint mismatch at %d: %s" % (height, _hash)
+                confirmed = i + 1
+        return prev_hash, confirmed
+
+    def verify_raw_header(self, raw_header, prev_hash, bits, target):
+        '''Same checks as verify_header, on a serialized header.  Hashes
+        are in internal byte order.  Returns the hash of the header.'''
+        assert raw_header[4:36] == prev_hash, "prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(raw_header[4:36]))
+        header_bits = struct.unpack_from('<I', raw_header, 72)[0]
+        assert bits == header_bits, "bits mismatch: %s vs %s" % (bits, header_bits)
+        _hash = Hash(raw_header)
+        work = int(_hash[::-1].encode('hex'), 16)
+        assert work <= target, "insufficient proof of work: %s vs target %s" % (work, target)
+        return _hash
 
     def serialize_header(self, res):
         s = int_to_hex(res.get('version'), 4) \
@@ -85,15 +164,12 @@ class Blockchain(util.PrintError):
             + int_to_hex(int(res.get('nonce')), 4)
         return s
 
-    def deserialize_header(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
+    def deserialize_header(self, s, offset=0):
         h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
+        h['version'], prev_hash, merkle_root, h['timestamp'], h['bits'], h['nonce'] = \
+            struct.unpack_from('<I32s32sIII', s, offset)
+        h['prev_block_hash'] = prev_hash[::-1].encode('hex')
+        h['merkle_root'] = merkle_root[::-1].encode('hex')
         return h
 
     def hash_header(self, header):
@@ -118,53 +194,186 @@ class Blockchain(util.PrintError):
             self.print_error("download failed. creating file", filename)
             open(filename, 'wb+').close()
 
-    def save_chunk(self, index, chunk):
+    def open_headers(self):
+        '''Map the headers file in memory.  The file is not padded, since
+        its size gives the local height, so the map is replaced whenever
+        the file grows.  The map is only used with headers_lock held.'''
+        with self.headers_lock:
+            self._open_headers()
+
+    def _close_headers(self):
+        if self.headers is not None:
+            self.headers.close()
+            self.headers = None
+
+    def _open_headers(self):
+        self._close_headers()
         filename = self.path()
-        f = open(filename, 'rb+')
-        f.seek(index * 2016 * 80)
-        h = f.write(chunk)
-        f.close()
-        self.set_local_height()
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb+') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                self.headers = mmap.mmap(f.fileno(), size)
+
+    def write_headers(self, offset, data):
+        with self.headers_lock:
+            if self.headers is not None and offset + len(data) <= len(self.headers):
+                self.headers[offset:offset + len(data)] = data
+                return
+            with open(self.path(), 'rb+') as f:
+                f.seek(offset)
+                f.write(data)
+            self._open_headers()
+
+    def save_chunk(self, index, chunk, confirmed=None):
+        '''Store the first confirmed headers of a verified chunk, all of
+        them by default, and keep the others in memory until a later
+        chunk leads them to a checkpoint.  These can be all the headers
+        between two checkpoints, about 20 chunks with the current table;
+        they are not saved, so they are downloaded again after a
+        restart.  Returns False if the headers were ignored.'''
+        height = index * 2016
+        end = self.unconfirmed_height + len(self.unconfirmed) / 80
+        if self.unconfirmed and self.unconfirmed_height <= height <= end:
+            data = self.unconfirmed[:(height - self.unconfirmed_height) * 80] + chunk
+        else:
+            data, self.unconfirmed_height = chunk, height
+        if confirmed is None:
+            confirmed = len(chunk) / 80
+        if not confirmed:
+            self.unconfirmed = data
+            return True
+        # the unconfirmed headers before the chunk lead to it
+        n = (height - self.unconfirmed_height + confirmed) * 80
+        self.unconfirmed = ''
+        if not self.save_headers(self.unconfirmed_height, data[:n], checkpointed=True):
+            return False
+        self.unconfirmed = data[n:]
+        self.unconfirmed_height += n / 80
+        return True
 
     def save_header(self, header):
         data = self.serialize_header(header).decode('hex')
         assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename, 'rb+')
-        f.seek(height * 80)
-        h = f.write(data)
-        f.close()
+        return self.save_headers(header.get('block_height'), data)
+
+    def save_headers(self, height, data, checkpointed=False):
+        '''Store serialized headers from height on.  Headers that
+        replace other headers start a new branch.  Below the last
+        checkpoint, it is kept only if it is checkpointed, as ours then
+        contradicts a checkpoint; above, only if it has more work.
+        Our headers above the fork are then dropped, and a 'reorg' is
+        notified with the height of the first replaced header.  Returns
+        False if the headers were ignored.'''
+        fork = None
+        for i in range(len(data) / 80):
+            old = self.read_raw_header(height + i)
+            if old is None:
+                break
+            if old != data[i*80:(i+1)*80]:
+                fork = height + i
+                break
+        if fork is not None:
+            # checkpoints decide below the last one, work above it,
+            # where all the headers had their difficulty verified
+            if fork <= CHECKPOINTS[-1][0]:
+                if not checkpointed:
+                    self.print_error("ignoring fork below the last checkpoint at height %d" % fork)
+                    return False
+                self.print_error("reorg at height %d, to a checkpoint" % fork)
+            else:
+                ours = self.read_raw_headers(fork, self.local_height + 1)
+                if self.chain_work(data[(fork - height) * 80:]) <= self.chain_work(ours):
+                    self.print_error("ignoring fork at height %d, not enough work" % fork)
+                    return False
+                self.print_error("reorg at height %d" % fork)
+            self.truncate(fork - 1)
+        self.write_headers(height * 80, data)
         self.set_local_height()
+        if fork is not None and self.network:
+            self.network.trigger_callback('reorg', fork)
+        return True
+
+    def truncate(self, height):
+        "Drop the headers above height"
+        with self.headers_lock:
+            # unmap the file first: touching a page past the end of the
+            # file would kill the process, and Windows cannot truncate
+            # a mapped file
+            self._close_headers()
+            with open(self.path(), 'rb+') as f:
+                f.truncate((height + 1) * 80)
+            self._open_headers()
+        self.set_local_height()
+        if height < self.unconfirmed_height - 1:
+            self.unconfirmed = ''
+
+    def chain_work(self, data):
+        "Expected number of hashes to mine the serialized headers"
+        work = 0
+        for i in range(len(data) / 80):
+            bits = struct.unpack_from('<I', data, i*80 + 72)[0]
+            work += 2**256 / (self.bits_to_target(bits) + 1)
+        return work
+
+    def bits_to_target(self, bits):
+        bitsN, bitsBase = bits >> 24, bits & 0xffffff
+        if bitsN < 3:
+            return bitsBase >> (8 * (3 - bitsN))
+        return bitsBase << (8 * (bitsN - 3))
 
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
-            if self.local_height != h:
-                self.local_height = h
-
-    def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name, 'rb')
-            f.seek(block_height * 80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.deserialize_header(h)
-                return h
+        with self.headers_lock:
+            if self.headers is not None:
+                self.local_height = len(self.headers) / 80 - 1
+            elif os.path.exists(self.path()):
+                self.local_height = -1
+
+    def read_raw_header(self, block_height):
+        if block_height < 0:
+            return
+        offset = block_height * 80
+        with self.headers_lock:
+            if self.headers is not None and offset + 80 <= len(self.headers):
+                return self.headers[offset:offset + 80]
+
+    def read_unconfirmed_header(self, block_height):
+        "Same as read_raw_header, including the unconfirmed headers"
+        i = block_height - self.unconfirmed_height
+        if 0 <= i < len(self.unconfirmed) / 80:
+            return self.unconfirmed[i*80:(i+1)*80]
+        return self.read_raw_header(block_height)
+
+    def read_raw_headers(self, start, end):
+        "Serialized headers from start to end - 1, as far as we have them"
+        with self.headers_lock:
+            if self.headers is None or start >= end:
+                return ''
+            return self.headers[start * 80:end * 80]
+
+    def read_header(self, block_height, unconfirmed=False):
+        if unconfirmed:
+            raw_header = self.read_unconfirmed_header(block_height)
+        else:
+            raw_header = self.read_raw_header(block_height)
+        if raw_header is not None:
+            return self.deserialize_header(raw_header)
 
     def get_target(self, index, chain=None):
         if index == 0:
             return 0x1d00ffff, MAX_TARGET
-        first = self.read_header((index-1) * 2016)
-        last = self.read_header(index*2016 - 1)
-        if last is None:
-            for h in chain:
-                if h.get('block_height') == index*2016 - 1:
-                    last = h
-        assert last is not None
+        # the headers of a chain replace ours
+        first = last = None
+        for h in chain or []:
+            if h.get('block_height') == (index-1) * 2016:
+                first = h
+            if h.get('block_height') == index*2016 - 1:
+                last = h
+        # the previous period may not lead to a checkpoint yet
+        first = first or self.read_header((index-1) * 2016, unconfirmed=True)
+        last = last or self.read_header(index*2016 - 1, unconfirmed=True)
+        assert first is not None and last is not None
         # bits to target
         bits = last.get('bits')
         bitsN = (bits >> 24) & 0xff
@@ -192,39 +401,79 @@ class Blockchain(util.PrintError):
     def connect_header(self, chain, header):
         '''Builds a header chain until it connects.  Returns True if it has
         successfully connected, False if verification failed, otherwise the
-        height of the next header needed.'''
+        height of the next header needed.  If we have a header at that
+        height, the chain forks below it: the fork is then found with
+        connect_fork_chunk, instead of one header at a time.'''
         chain.append(header)  # Ordered by decreasing height
         previous_height = header['block_height'] - 1
-        previous_header = self.read_header(previous_height)
 
         # Missing header, request it
-        if not previous_header:
+        if previous_height > self.local_height:
             return previous_height
 
         # Does it connect to my chain?
-        prev_hash = self.hash_header(previous_header)
-        if prev_hash != header.get('prev_block_hash'):
-            self.print_error("reorg")
+        if previous_height < 0:
+            connects = header.get('prev_block_hash') == '0' * 64
+        else:
+            previous_header = self.read_header(previous_height)
+            connects = self.hash_header(previous_header) == header.get('prev_block_hash')
+        if not connects:
+            if previous_height <= CHECKPOINTS[-1][0]:
+                self.print_error("fork below the last checkpoint")
+                return False
+            self.print_error("fork")
             return previous_height
 
         # The chain is complete.  Reverse to order by increasing height
         chain.reverse()
         try:
             self.verify_chain(chain)
-            self.print_error("new height:", previous_height + len(chain))
-            for header in chain:
-                self.save_header(header)
-            return True
         except BaseException as e:
             self.print_error(str(e))
             return False
+        # A competing branch is only kept if it has more work
+        data = ''.join(self.serialize_header(h) for h in chain).decode('hex')
+        if self.save_headers(previous_height + 1, data):
+            self.print_error("new height:", previous_height + len(chain))
+        return True
+
+    def connect_fork_chunk(self, chain, idx, hexdata):
+        '''Connects a header chain built by connect_header that forks
+        from ours, with chunk idx of the same server, which holds the
+        parent of its first header.  The fork is the first header of the
+        chunk that differs from ours.  Returns True if the chain has
+        connected, False if verification failed, otherwise the index of
+        the previous chunk, if the fork is below this one.'''
+        start = idx * 2016
+        height = chain[-1]['block_height']
+        data = hexdata.decode('hex')[:(height - start) * 80]
+        if height <= start or len(data) != (height - start) * 80:
+            self.print_error("chunk %d does not lead to the fork" % idx)
+            return False
+        ours = self.read_raw_headers(start, height)
+        # the headers of the chunk below the fork are the same as ours
+        i = len(data) / 80
+        while i > 0 and data[(i-1)*80:i*80] != ours[(i-1)*80:i*80]:
+            i -= 1
+            header = self.deserialize_header(data, i*80)
+            header['block_height'] = start + i
+            chain.append(header)
+        fork = start + i
+        if fork <= CHECKPOINTS[-1][0]:
+            self.print_error("fork below the last checkpoint")
+            return False
+        if fork == start:
+            return idx - 1
+        self.print_error("fork at height %d" % fork)
+        return self.connect_header(chain[:-1], chain[-1]) is True
 
     def connect_chunk(self, idx, hexdata):
         try:
             data = hexdata.decode('hex')
-            self.verify_chunk(idx, data)
+            confirmed = self.verify_chunk(idx, data)
             self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
+            if not self.save_chunk(idx, data, confirmed):
+                return idx - 1
             return idx + 1
         except BaseException as e:
             self.print_error('verify_chunk failed', str(e))
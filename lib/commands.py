@@ -229,16 +229,16 @@ class Commands:
         return tx.as_dict()
 
     @command('wp')
-    def signtransaction(self, tx, privkey=None):
+    def signtransaction(self, tx, privkey=None, processes=None):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
         tx = Transaction(tx)
         if privkey:
             pubkey = bitcoin.public_key_from_private_key(privkey)
             h160 = bitcoin.hash_160(pubkey.decode('hex'))
             x_pubkey = 'fd' + (chr(0) + h160).encode('hex')
-            tx.sign({x_pubkey:privkey})
+            tx.sign({x_pubkey:privkey}, processes=processes)
         else:
-            self.wallet.sign_transaction(tx, self._password)
+            self.wallet.sign_transaction(tx, self._password, processes)
         return tx.as_dict()
 
     @command('')
@@ -409,7 +409,7 @@ class Commands:
         sig = base64.b64decode(signature)
         return bitcoin.verify_message(address, sig, message)
 
-    def _mktx(self, outputs, fee, change_addr, domain, nocheck, unsigned, rbf):
+    def _mktx(self, outputs, fee, change_addr, domain, nocheck, unsigned, rbf, processes):
         self.nocheck = nocheck
         change_addr = self._resolver(change_addr)
         domain = None if domain is None else map(self._resolver, domain)
@@ -430,29 +430,29 @@ class Commands:
         if rbf:
             tx.set_sequence(0)
         if not unsigned:
-            self.wallet.sign_transaction(tx, self._password)
+            self.wallet.sign_transaction(tx, self._password, processes)
         return tx
 
     @command('wp')
-    def payto(self, destination, amount, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=False):
+    def payto(self, destination, amount, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=False, processes=None):
         """Create a transaction. """
         domain = [from_addr] if from_addr else None
-        tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned, rbf)
+        tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned, rbf, processes)
         return tx.as_dict()
 
     @command('wp')
-    def paytomany(self, outputs, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=False):
+    def paytomany(self, outputs, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=False, processes=None):
         """Create a multi-output transaction. """
         domain = [from_addr] if from_addr else None
-        tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf)
+        tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned, rbf, processes)
         return tx.as_dict()
 
     @command('w')
-    def history(self):
+    def history(self, from_height=None, to_height=None, offset=0, count=None):
         """Wallet history. Returns the transaction history of your wallet."""
         balance = 0
         out = []
-        for item in self.wallet.get_history():
+        for item in self.wallet.get_history(None, from_height, to_height, offset, count):
             tx_hash, height, conf, timestamp, value, balance = item
             if timestamp:
                 date = datetime.datetime.fromtimestamp(timestamp).isoformat(' ')[:-3]
@@ -689,6 +689,11 @@ command_options = {
     'pending':     (None, "--pending",     "Show only pending requests."),
     'expired':     (None, "--expired",     "Show only expired requests."),
     'paid':        (None, "--paid",        "Show only paid requests."),
+    'from_height': (None, "--from_height", "Only show transactions from this block height"),
+    'to_height':   (None, "--to_height",   "Only show transactions up to this block height"),
+    'offset':      (None, "--offset",      "Number of most recent transactions to skip"),
+    'count':       (None, "--count",       "Maximum number of transactions to show"),
+    'processes':   (None, "--processes",   "Number of processes used to sign the transaction"),
 }
 
 
@@ -697,6 +702,11 @@ from transaction import tx_from_str
 json_loads = lambda x: json.loads(x, parse_float=lambda x: str(Decimal(x)))
 arg_types = {
     'num': int,
+    'from_height': int,
+    'to_height': int,
+    'offset': int,
+    'count': int,
+    'processes': int,
     'nbits': int,
     'entropy': long,
     'tx': tx_from_str,
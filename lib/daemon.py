@@ -32,9 +32,9 @@ import jsonrpclib
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
 from network import Network
-from util import json_decode, DaemonThread
+from util import json_decode, DaemonThread, get_save_scheduler
 from util import print_msg, print_error, print_stderr
-from wallet import WalletStorage, Wallet
+from wallet import WalletStorage, Wallet, get_storage_class
 from commands import known_commands, Commands
 from simple_config import SimpleConfig
 
@@ -174,13 +174,14 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
-        storage = WalletStorage(path)
+        storage = get_storage_class(self.config)(path)
         if not storage.file_exists:
             return
         wallet = Wallet(storage)
         action = wallet.get_action()
         if action:
             return
+        wallet.unlock_ttl = self.config.get('unlock_ttl', 0)
         wallet.start_threads(self.network)
         self.wallets[path] = wallet
         return wallet
@@ -221,6 +222,7 @@ class Daemon(DaemonThread):
             self.print_error("shutting down network")
             self.network.stop()
             self.network.join()
+        get_save_scheduler().flush()
         self.on_stop()
 
     def stop(self):
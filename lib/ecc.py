@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2016 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Point arithmetic on secp256k1.
+#
+# Points are passed around as affine (x, y) tuples, and None for the
+# point at infinity.  Internally, sums are computed in Jacobian
+# coordinates (X, Y, Z), standing for (X/Z^2, Y/Z^3), so that a single
+# modular inverse is needed per result.  Multiples of the generator use
+# a precomputed table, other points use a width-5 NAF.
+
+import threading
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+WINDOW = 4
+WNAF_WIDTH = 5
+
+
+def inverse(a, n=P):
+    return pow(a, n - 2, n)
+
+
+def jacobian_double(p):
+    if p is None:
+        return None
+    X, Y, Z = p
+    if Y == 0:
+        return None
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y * Z % P
+    return X3, Y3, Z3
+
+
+def jacobian_add(p, q):
+    if p is None:
+        return q
+    if q is None:
+        return p
+    X1, Y1, Z1 = p
+    X2, Y2, Z2 = q
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    U2 = X2 * Z1Z1 % P
+    S1 = Y1 * Z2 * Z2Z2 % P
+    S2 = Y2 * Z1 * Z1Z1 % P
+    if U1 == U2:
+        if S1 != S2:
+            return None
+        return jacobian_double(p)
+    H = (U2 - U1) % P
+    R = (S2 - S1) % P
+    HH = H * H % P
+    HHH = H * HH % P
+    V = U1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - S1 * HHH) % P
+    Z3 = H * Z1 * Z2 % P
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(p, q):
+    "add an affine point q to a Jacobian point p"
+    if q is None:
+        return p
+    if p is None:
+        return q[0], q[1], 1
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    if X1 == U2:
+        if Y1 != S2:
+            return None
+        return jacobian_double(p)
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = H * Z1 % P
+    return X3, Y3, Z3
+
+
+def to_affine(p):
+    if p is None:
+        return None
+    X, Y, Z = p
+    z = inverse(Z)
+    zz = z * z % P
+    return X * zz % P, Y * zz * z % P
+
+
+def negate(p):
+    if p is None:
+        return None
+    return p[0], (P - p[1]) % P
+
+
+# G_TABLE[i][j-1] = j * 2^(WINDOW*i) * G, in affine coordinates
+G_TABLE = None
+g_table_lock = threading.Lock()
+
+def get_g_table():
+    global G_TABLE
+    with g_table_lock:
+        if G_TABLE is None:
+            table = []
+            base = G
+            for i in range((256 + WINDOW - 1) / WINDOW):
+                row = [base]
+                p = (base[0], base[1], 1)
+                for j in range(2, 1 << WINDOW):
+                    p = jacobian_add_affine(p, base)
+                    row.append(to_affine(p))
+                table.append(row)
+                base = to_affine(jacobian_add_affine(p, base))
+            G_TABLE = table
+    return G_TABLE
+
+
+def jacobian_mul_G(k):
+    table = G_TABLE or get_g_table()
+    k %= N
+    mask = (1 << WINDOW) - 1
+    acc = None
+    i = 0
+    while k:
+        d = k & mask
+        if d:
+            acc = jacobian_add_affine(acc, table[i][d - 1])
+        k >>= WINDOW
+        i += 1
+    return acc
+
+
+def wnaf(k, width=WNAF_WIDTH):
+    "return the width-w NAF digits of k, least significant first"
+    digits = []
+    half = 1 << (width - 1)
+    full = 1 << width
+    while k:
+        if k & 1:
+            d = k % full
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def jacobian_mul(p, k):
+    k %= N
+    if p is None or k == 0:
+        return None
+    # odd multiples p, 3p, 5p, ...
+    p2 = jacobian_double((p[0], p[1], 1))
+    odd = [(p[0], p[1], 1)]
+    for i in range(1, 1 << (WNAF_WIDTH - 2)):
+        odd.append(jacobian_add(odd[-1], p2))
+    acc = None
+    for d in reversed(wnaf(k)):
+        acc = jacobian_double(acc)
+        if d > 0:
+            acc = jacobian_add(acc, odd[d / 2])
+        elif d < 0:
+            X, Y, Z = odd[-d / 2]
+            acc = jacobian_add(acc, (X, P - Y, Z))
+    return acc
+
+
+def mul_G(k):
+    "k * G"
+    return to_affine(jacobian_mul_G(k))
+
+
+def mul(p, k):
+    "k * p"
+    return to_affine(jacobian_mul(p, k))
+
+
+def add(p, q):
+    "p + q"
+    if p is None:
+        return q
+    return to_affine(jacobian_add_affine((p[0], p[1], 1), q))
+
+
+def mul_add(p, a, b):
+    "a * p + b * G"
+    return to_affine(jacobian_add(jacobian_mul(p, a), jacobian_mul_G(b)))
+
+
+def is_on_curve(p):
+    x, y = p
+    return 0 <= x < P and 0 <= y < P and (y * y - x * x * x - 7) % P == 0
+
+
+def y_from_x(x, odd):
+    y2 = (x * x * x + 7) % P
+    y = pow(y2, (P + 1) / 4, P)
+    if y * y % P != y2:
+        raise ValueError('x is not on the curve')
+    return y if bool(y & 1) == odd else P - y
+
+
+def ser_to_point(s):
+    "parse a serialized public key"
+    if len(s) == 33 and s[0] in '\x02\x03':
+        x = int(s[1:].encode('hex'), 16)
+        return x, y_from_x(x, s[0] == '\x03')
+    if len(s) == 65 and s[0] == '\x04':
+        p = int(s[1:33].encode('hex'), 16), int(s[33:].encode('hex'), 16)
+        if not is_on_curve(p):
+            raise ValueError('point is not on the curve')
+        return p
+    raise ValueError('invalid public key')
+
+
+def point_to_ser(p, compressed=True):
+    x, y = p
+    if compressed:
+        return ('%02x%064x' % (2 + (y & 1), x)).decode('hex')
+    return ('04%064x%064x' % (x, y)).decode('hex')
+
+
+def verify(p, z, r, s):
+    "check an ECDSA signature (r, s) of the number z by the public key p"
+    if not (0 < r < N and 0 < s < N):
+        return False
+    w = inverse(s, N)
+    R = mul_add(p, r * w % N, z * w % N)
+    return R is not None and R[0] % N == r
+
+
+def recover(z, r, s, recid):
+    "return the public key that made the signature (r, s) of z, see SEC1 4.1.6"
+    x = r + (recid / 2) * N
+    if x >= P:
+        raise ValueError('invalid recid')
+    R = x, y_from_x(x, bool(recid & 1))
+    inv_r = inverse(r, N)
+    # Q = r^-1 (sR - zG)
+    Q = mul_add(R, s * inv_r % N, -z * inv_r % N)
+    if Q is None:
+        raise ValueError('recovered point at infinity')
+    return Q
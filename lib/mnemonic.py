@@ -31,7 +31,6 @@ import unicodedata
 import string
 
 import ecdsa
-import pbkdf2
 
 from util import print_error
 from bitcoin import is_old_seed, is_new_seed
@@ -101,6 +100,19 @@ filenames = {
 }
 
 
+def pbkdf2_sha512(password, salt, iterations):
+    "PBKDF2-HMAC-SHA512, 64 bytes. Unicode arguments are encoded in UTF-8."
+    if isinstance(password, unicode):
+        password = password.encode('utf8')
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf8')
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha512', password, salt, iterations)
+    # Python < 2.7.8
+    import pbkdf2
+    return pbkdf2.PBKDF2(password, salt, iterations=iterations, macmodule=hmac,
+                         digestmodule=hashlib.sha512).read(64)
+
 
 class Mnemonic(object):
     # Seed derivation no longer follows BIP39
@@ -127,7 +139,7 @@ class Mnemonic(object):
     def mnemonic_to_seed(self, mnemonic, passphrase):
         PBKDF2_ROUNDS = 2048
         mnemonic = prepare_seed(mnemonic)
-        return pbkdf2.PBKDF2(mnemonic, 'electrum' + passphrase, iterations = PBKDF2_ROUNDS, macmodule = hmac, digestmodule = hashlib.sha512).read(64)
+        return pbkdf2_sha512(mnemonic, 'electrum' + passphrase, PBKDF2_ROUNDS)
 
     def mnemonic_encode(self, i):
         n = len(self.wordlist)
@@ -66,6 +66,9 @@ DEFAULT_SERVERS = {
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# header chunks requested at a time, over all interfaces
+MAX_PENDING_CHUNKS = 8
+CHUNK_TIMEOUT = 20
 
 
 def parse_servers(result):
@@ -706,26 +709,82 @@ class Network(util.DaemonThread):
                 else:
                     self.switch_to_interface(self.default_server)
 
-    def request_chunk(self, interface, data, idx):
-        interface.print_error("requesting chunk %d" % idx)
-        self.queue_request('blockchain.block.get_chunk', [idx], interface)
-        data['chunk_idx'] = idx
-        data['req_time'] = time.time()
+    def request_chunks(self, interface, data):
+        '''Request the chunks of the next MAX_PENDING_CHUNKS that are
+        neither pending nor received, spread over the interfaces that
+        have those chunks, and retry requests that failed or timed out
+        with other interfaces.  Returns False if the chunks cannot be
+        downloaded.'''
+        pending = data['pending_chunks']
+        failed = data['failed_chunks']
+        interfaces = self.interfaces.values()
+        now = time.time()
+        for idx, (i, req_time) in pending.items():
+            if i not in interfaces or now - req_time > CHUNK_TIMEOUT:
+                i.print_error("chunk request timed out", idx)
+                failed[idx].add(i.server)
+                del pending[idx]
+        # the window counts both pending and received chunks
+        last = min(data['last_chunk'], data['chunk_idx'] + MAX_PENDING_CHUNKS - 1)
+        for idx in range(data['chunk_idx'], last + 1):
+            if idx in pending or idx in data['chunks']:
+                continue
+            height = min(idx * 2016 + 2015, data['if_height'])
+            candidates = [i for i in interfaces
+                          if self.heights.get(i.server, 0) >= height]
+            if (candidates and data['retries'] < 3
+                and failed[idx].issuperset(i.server for i in candidates)):
+                # after a reorg, even good servers fail until the
+                # previous chunk is replaced
+                data['retries'] += 1
+                failed[idx].clear()
+            candidates = [i for i in candidates if i.server not in failed[idx]]
+            if not candidates:
+                break
+            load = lambda i: sum(1 for j, t in pending.values() if j == i)
+            i = min(candidates, key=load)
+            i.print_error("requesting chunk %d" % idx)
+            self.queue_request('blockchain.block.get_chunk', [idx], i)
+            pending[idx] = (i, now)
+        return bool(pending)
 
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
-        if self.bc_requests:
-            req_if, data = self.bc_requests[0]
-            req_idx = data.get('chunk_idx')
-            # Ignore unsolicited chunks
-            if req_if == interface and req_idx == response['params'][0]:
-                idx = self.blockchain.connect_chunk(req_idx, response['result'])
-                # If not finished, get the next chunk
-                if idx < 0 or self.get_local_height() >= data['if_height']:
-                    self.bc_requests.popleft()
-                    self.notify('updated')
-                else:
-                    self.request_chunk(interface, data, idx)
+        if not self.bc_requests:
+            return
+        req_if, data = self.bc_requests[0]
+        idx = response['params'][0]
+        if 'fork_chunk' in data:
+            if req_if == interface and data['fork_chunk'] == idx:
+                self.on_get_fork_chunk(interface, data, response)
+            return
+        pending = data.get('pending_chunks', {})
+        # Ignore unsolicited chunks
+        if idx not in pending or pending[idx][0] != interface:
+            return
+        del pending[idx]
+        if response.get('error'):
+            interface.print_error("chunk request failed", idx, response['error'])
+            data['failed_chunks'][idx].add(interface.server)
+        else:
+            data['chunks'][idx] = interface, response['result']
+        # Connect the chunks that follow our blockchain, in order
+        next_idx = data['chunk_idx']
+        while next_idx in data['chunks']:
+            i, hexdata = data['chunks'].pop(next_idx)
+            idx, next_idx = next_idx, self.blockchain.connect_chunk(next_idx, hexdata)
+            if next_idx != idx + 1:
+                # Get this chunk from another server, after the
+                # previous one, in case the chain was reorganized.
+                # The chunks received above it are kept.
+                data['failed_chunks'][idx].add(i.server)
+        data['chunk_idx'] = next_idx
+        # If not finished, request more chunks
+        if (next_idx < 0 or next_idx > data['last_chunk']
+            or self.get_local_height() >= data['if_height']
+            or not self.request_chunks(req_if, data)):
+            self.bc_requests.popleft()
+            self.notify('updated')
 
     def request_header(self, interface, data, height):
         interface.print_error("requesting header %d" % height)
@@ -735,6 +794,13 @@ class Network(util.DaemonThread):
         if not 'chain' in data:
             data['chain'] = []
 
+    def request_fork_chunk(self, interface, data, idx):
+        interface.print_error("requesting chunk %d to find the fork" % idx)
+        self.queue_request('blockchain.block.get_chunk', [idx], interface)
+        data.pop('header_height', None)
+        data['fork_chunk'] = idx
+        data['req_time'] = time.time()
+
     def on_get_header(self, interface, response):
         '''Handle receiving a single block header'''
         if self.bc_requests:
@@ -745,16 +811,35 @@ class Network(util.DaemonThread):
                 next_height = self.blockchain.connect_header(data['chain'], response['result'])
                 # If not finished, get the next header
                 if next_height in [True, False]:
-                    self.bc_requests.popleft()
-                    if next_height:
-                        self.switch_lagging_interface(interface.server)
-                        self.notify('updated')
-                    else:
-                        interface.print_error("header didn't connect, dismissing interface")
-                        interface.stop()
+                    self.on_headers_connected(interface, next_height)
+                elif next_height <= self.get_local_height():
+                    # the chain forks below next_height: look for the
+                    # fork in the chunk that holds it
+                    self.request_fork_chunk(interface, data, next_height / 2016)
                 else:
                     self.request_header(interface, data, next_height)
 
+    def on_get_fork_chunk(self, interface, data, response):
+        '''Handle receiving the chunk requested by request_fork_chunk'''
+        if response.get('error'):
+            interface.print_error("chunk request failed", response['error'])
+            result = False
+        else:
+            result = self.blockchain.connect_fork_chunk(data['chain'], data['fork_chunk'], response['result'])
+        if isinstance(result, bool):
+            self.on_headers_connected(interface, result)
+        else:
+            self.request_fork_chunk(interface, data, result)
+
+    def on_headers_connected(self, interface, connected):
+        self.bc_requests.popleft()
+        if connected:
+            self.switch_lagging_interface(interface.server)
+            self.notify('updated')
+        else:
+            interface.print_error("header didn't connect, dismissing interface")
+            interface.stop()
+
     def bc_request_headers(self, interface, data):
         '''Send a request for the next header, or a chunk of them,
         if necessary.
@@ -763,7 +848,14 @@ class Network(util.DaemonThread):
         if if_height <= local_height:
             return False
         elif if_height > local_height + 50:
-            self.request_chunk(interface, data, (local_height + 1) / 2016)
+            data['chunk_idx'] = (local_height + 1) / 2016
+            data['last_chunk'] = if_height / 2016
+            data['pending_chunks'] = {}
+            data['chunks'] = {}
+            data['failed_chunks'] = defaultdict(set)
+            data['retries'] = 0
+            data['req_time'] = time.time()
+            return self.request_chunks(interface, data)
         else:
             self.request_header(interface, data, if_height)
         return True
@@ -774,6 +866,14 @@ class Network(util.DaemonThread):
         '''
         while self.bc_requests:
             interface, data = self.bc_requests.popleft()
+            if 'pending_chunks' in data:
+                # Chunks are downloaded from several interfaces, with
+                # their own timeouts.  The download goes on while any
+                # of them is connected, even without this interface.
+                if not self.request_chunks(interface, data):
+                    continue
+                self.bc_requests.appendleft((interface, data))
+                break
             # If the connection was lost move on
             if not interface in self.interfaces.values():
                 continue
@@ -42,7 +42,7 @@ except ImportError:
 
 import bitcoin
 import util
-from util import print_error
+from util import print_error, get_save_scheduler
 import transaction
 import x509
 import rsakey
@@ -469,12 +469,12 @@ class InvoiceStore(object):
     def add(self, pr):
         key = pr.get_id()
         self.invoices[key] = pr
-        self.save()
+        get_save_scheduler().schedule(self.save)
         return key
 
     def remove(self, key):
         self.invoices.pop(key)
-        self.save()
+        get_save_scheduler().schedule(self.save)
 
     def get(self, k):
         return self.invoices.get(k)
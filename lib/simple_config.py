@@ -4,7 +4,7 @@ import threading
 import os
 
 from copy import deepcopy
-from util import user_dir, print_error, print_msg, print_stderr, PrintError
+from util import user_dir, print_error, print_msg, print_stderr, PrintError, get_save_scheduler
 
 SYSTEM_CONFIG_PATH = "/etc/electrum.conf"
 
@@ -109,8 +109,8 @@ class SimpleConfig(PrintError):
 
         with self.lock:
             self.user_config[key] = value
-            if save:
-                self.save_user_config()
+        if save:
+            get_save_scheduler().schedule(self.save_user_config)
         return
 
     def get(self, key, default=None):
@@ -129,7 +129,8 @@ class SimpleConfig(PrintError):
         if not self.path:
             return
         path = os.path.join(self.path, "config")
-        s = json.dumps(self.user_config, indent=4, sort_keys=True)
+        with self.lock:
+            s = json.dumps(self.user_config, indent=4, sort_keys=True)
         f = open(path, "w")
         f.write(s)
         f.close()
@@ -72,6 +72,10 @@ class Synchronizer(ThreadJob):
         with self.lock:
             self.new_addresses.add(address)
 
+    def add_addresses(self, addresses):
+        with self.lock:
+            self.new_addresses.update(addresses)
+
     def subscribe_to_addresses(self, addresses):
         if addresses:
             self.requested_addrs |= addresses
@@ -93,7 +97,10 @@ class Synchronizer(ThreadJob):
             return
         addr = params[0]
         history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        # addresses removed from the wallet stay subscribed
+        if not self.wallet.is_mine(addr):
+            pass
+        elif self.get_status(history) != result:
             if self.requested_histories.get(addr) is None:
                 self.requested_histories[addr] = result
                 self.network.send([('blockchain.address.get_history', [addr])],
@@ -157,7 +164,7 @@ class Synchronizer(ThreadJob):
         # "hist" is a list of [tx_hash, tx_height] lists
         missing = set()
         for tx_hash, tx_height in hist:
-            if self.wallet.transactions.get(tx_hash) is None:
+            if tx_hash not in self.wallet.transactions:
                 missing.add((tx_hash, tx_height))
         missing -= self.requested_tx
         if missing:
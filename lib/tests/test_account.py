@@ -1,3 +1,4 @@
+import multiprocessing
 import unittest
 
 from lib import account
@@ -55,6 +56,13 @@ class Test_Account(unittest.TestCase):
         self.assertEquals(a.get_private_key(sequence=[0, 0], wallet=w, password=None),
                           ['KxuBFG13CPUBwPAUWvZSQ3mjNNjHoDghfxnax6RbwS3Rw8tqSzCk'])
 
+        self.assertEquals(a.get_address_index(a.get_address(1, 4)), (1, 4))
+        self.assertEquals(a.get_address_index(a.get_address(0, 19)), (0, 19))
+        self.assertEquals(a.get_address_index('1EtJphMVpes4UKm8bYu5D1fGvNoTSJM3ZL'), (0, 0))
+        self.assertEquals(a.get_address_index('1Got6wbjxQ592WfwLcfLLxn3aTetLzpTom'), None)
+        address = a.create_new_address(1)
+        self.assertEquals(a.get_address_index(address), (1, 6))
+
         for for_change in [0, 1]:
             for n in range(6):
                 label = ['receiving', 'change'][for_change]
@@ -67,6 +75,26 @@ class Test_Account(unittest.TestCase):
                 xpub, seq = a.parse_xpubkey(pubkey)
                 self.assertEquals(xpub, a.xpub)
                 self.assertEquals(seq, [for_change, n])
+            label = ['receiving', 'change'][for_change]
+            self.assertEquals(a.derive_range(for_change, 1, 5), v[label][1:6])
+            c, cK = a.get_branch(a.xpub, for_change)
+            pool = multiprocessing.Pool(2)
+            try:
+                self.assertEquals(account.derive_range_parallel(c, cK, 1, 5, pool), v[label][1:6])
+            finally:
+                pool.terminate()
+                pool.join()
+
+        # when the pool fails, keys are derived in this process
+        pool = multiprocessing.Pool(1)
+        pool.terminate()
+        pool.join()
+        keys = a.derive_range(0, 0, account.PARALLEL_DERIVATION_MIN, pool)
+        self.assertEquals(keys[:len(v['receiving'])], v['receiving'])
+
+        m = account.Multisig_Account({'xpubs': [a.xpub, a.xpub], 'm': 2})
+        self.assertEquals(m.derive_range(0, 2, 2), [[v['receiving'][2]] * 2, [v['receiving'][3]] * 2])
+        self.assertEquals(m.derive_pubkeys(1, 3), [v['change'][3]] * 2)
 
     def test_old_account(self):
         v = {
@@ -111,6 +139,21 @@ class Test_Account(unittest.TestCase):
         privkey = a.get_private_key(sequence=[0, 0], wallet=w, password=None)
         self.assertEquals(privkey, ['5Khs7w6fBkogoj1v71Mdt4g8m5kaEyRaortmK56YckgTubgnrhz'])
 
+        # the seed is stretched once per context
+        storage = wallet.WalletStorage(None)
+        storage.put('seed', seed)
+        storage.put('wallet_type', 'old')
+        w = wallet.OldWallet(storage)
+        w.create_master_keys(None)
+        w.create_main_account()
+        with w.unlock(None) as context:
+            keys = [w.get_private_key_from_xpubkey(a.get_xpubkeys(0, n)[0], None, context)
+                    for n in range(3)]
+            self.assertEquals(context.secrets.keys(), ['0'])
+        self.assertEquals(context.secrets, {})
+        self.assertEquals(keys[0], privkey[0])
+        self.assertEquals(keys[2], a.get_private_key([0, 2], w, None)[0])
+
         for for_change in [0, 1]:
             for n in range(5):
                 label = ['receiving', 'change'][for_change]
@@ -121,3 +164,16 @@ class Test_Account(unittest.TestCase):
                 mpk, seq = a.parse_xpubkey(pubkey)
                 self.assertEquals(mpk, v['mpk'])
                 self.assertEquals(seq, [for_change, n])
+        self.assertEquals(a.derive_range(1, 2, 3), v['change'][2:5])
+
+    def test_imported_account(self):
+        a = account.ImportedAccount({'imported': {}})
+        a.add('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D', None, None, None)
+        a.add('15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma', None, None, None)
+        self.assertEquals(a.get_address_index('15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'), (0, 0))
+        self.assertEquals(a.get_address_index('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'), (0, 1))
+        a.remove('15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma')
+        self.assertEquals(a.get_address_index('15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'), None)
+        self.assertEquals(a.get_address_index('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'), (0, 0))
+        a.add('1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D', None, None, None)
+        self.assertEquals(a.get_addresses(0), ['1KSezYMhAJMWqFbVFB2JshYg69UpmEXR4D'])
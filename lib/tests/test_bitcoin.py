@@ -7,7 +7,8 @@ from lib.bitcoin import (
     bip32_root, bip32_public_derivation, bip32_private_derivation, pw_encode,
     pw_decode, Hash, public_key_from_private_key, address_from_private_key,
     is_valid, is_private_key, xpub_from_xprv, is_new_seed, is_old_seed,
-    var_int, op_push)
+    var_int, op_push, base_encode, base_decode, EncodeBase58Check,
+    DecodeBase58Check, xpub_cache)
 
 try:
     import ecdsa
@@ -136,6 +137,38 @@ class Test_bitcoin(unittest.TestCase):
         result = xpub_from_xprv(xprv, testnet=True)
         self.assertEqual(result, xpub)
 
+    def test_base58(self):
+        vectors = [
+            ('', '1'),
+            ('\0', '11'),
+            ('\0\0\x01', '112'),
+            ('\x61', '2g'),
+            ('\x62\x62\x62', 'a3gV'),
+            ('\0' + '\xff' * 20, '14ZrjxJnU1LA5xSyrWMNuXTvSYKwt'),
+            ('\x51\x6b\x6f\xcd\x0f', 'ABnLTmg'),
+        ]
+        for raw, encoded in vectors:
+            self.assertEqual(base_encode(raw, base=58), encoded)
+            if raw.strip('\0'):
+                self.assertEqual(base_decode(encoded, None, base=58), raw)
+        self.assertEqual(base_decode('2g', 2, base=58), None)
+        raw = ''.join(chr(i) for i in range(256))
+        for base in [58, 43]:
+            self.assertEqual(base_decode(base_encode(raw, base), None, base), raw)
+        self.assertEqual(len(DecodeBase58Check('1FHsTashEBUNPQwC1CwVjnKUxzwgw73pU4')), 21)
+        self.assertEqual(DecodeBase58Check('1FHsTashEBUNPQwC1CwVjnKUxzwgw73pU5'), None)
+
+    def test_xpub_cache(self):
+        xpub = "xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy"
+        xprv = "xprvA41z7zogVVwxVSgdKUHDy1SKmdb533PjDz7J6N6mV6uS3ze1ai8FHa8kmHScGpWmj4WggLyQjgPie1rFSruoUihUZREPSL39UNdE3BBDu76"
+        xpub_cache.clear()
+        payload = DecodeBase58Check(xpub)
+        self.assertEqual(xpub_cache[xpub], payload)
+        self.assertEqual(EncodeBase58Check(payload), xpub)
+        # private keys are not kept
+        self.assertEqual(EncodeBase58Check(DecodeBase58Check(xprv)), xprv)
+        self.assertEqual(len(xpub_cache), 2)
+
     def test_var_int(self):
         for i in range(0xfd):
             self.assertEqual(var_int(i), "{:02x}".format(i) )
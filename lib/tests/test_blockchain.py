@@ -0,0 +1,231 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import blockchain
+from lib.blockchain import Blockchain
+
+GENESIS = ('01000000000000000000000000000000000000000000000000000000000000000000'
+           '00003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a'
+           '29ab5f49ffff001d1dac2b7c')
+BLOCK_1 = ('010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000'
+           '982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649'
+           'ffff001d01e36299')
+BLOCK_2 = ('010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000'
+           'd5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649'
+           'ffff001d08d2bd61')
+GENESIS_HASH = '000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f'
+BLOCK_1_HASH = '00000000839a8e6886ab5951d76f411475428afc90947ee320161bbf18eb6048'
+
+
+class FakeConfig(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.events = []
+
+    def trigger_callback(self, event, *args):
+        self.events.append((event,) + args)
+
+
+class TestBlockchain(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.blockchain = Blockchain(FakeConfig(self.user_dir), None)
+        open(self.blockchain.path(), 'wb').close()
+        self.blockchain.open_headers()
+        self.blockchain.set_local_height()
+
+        self.checkpoints = blockchain.CHECKPOINTS
+
+    def tearDown(self):
+        blockchain.CHECKPOINTS = self.checkpoints
+        shutil.rmtree(self.user_dir)
+
+    def test_deserialize_header(self):
+        header = self.blockchain.deserialize_header(GENESIS.decode('hex'))
+        self.assertEqual(header['version'], 1)
+        self.assertEqual(header['prev_block_hash'], '00' * 32)
+        self.assertEqual(header['nonce'], 2083236893)
+        self.assertEqual(self.blockchain.serialize_header(header), GENESIS)
+        self.assertEqual(self.blockchain.hash_header(header), GENESIS_HASH)
+
+    def test_headers_file(self):
+        b = self.blockchain
+        self.assertEqual(b.height(), -1)
+        self.assertIsNone(b.read_header(0))
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH)]
+        genesis = b.deserialize_header(GENESIS.decode('hex'))
+        b.save_chunk(0, GENESIS.decode('hex') * 3)
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(b.read_header(2), genesis)
+        self.assertIsNone(b.read_header(3))
+        # a replacement header must have more work
+        header = dict(genesis, nonce=1, bits=0x1c00ffff, block_height=2)
+        b.save_header(header)
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(b.read_header(2)['nonce'], 1)
+        b.save_header(dict(header, block_height=3))
+        self.assertEqual(b.height(), 3)
+        self.assertEqual(os.path.getsize(b.path()), 4 * 80)
+        # a new instance reads the same file
+        b = Blockchain(FakeConfig(self.user_dir), None)
+        self.assertEqual(b.height(), 3)
+        self.assertEqual(b.read_header(3)['nonce'], 1)
+
+    def test_fork(self):
+        network = FakeNetwork()
+        b = Blockchain(FakeConfig(self.user_dir), network)
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH)]
+        b.save_chunk(0, (GENESIS + BLOCK_1 + BLOCK_2).decode('hex'))
+        # the same headers again are not a fork
+        b.save_headers(1, BLOCK_1.decode('hex'))
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(network.events, [])
+        # a competing header with the same work is ignored
+        block_1 = b.deserialize_header(BLOCK_1.decode('hex'))
+        self.assertFalse(b.save_header(dict(block_1, nonce=1, block_height=1)))
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(network.events, [])
+        # with more work, it rewinds the chain to the fork point
+        old_map = b.headers
+        self.assertTrue(b.save_header(dict(block_1, nonce=1, bits=0x1c00ffff, block_height=1)))
+        self.assertEqual(b.height(), 1)
+        self.assertEqual(network.events, [('reorg', 1)])
+        self.assertEqual(os.path.getsize(b.path()), 2 * 80)
+        # the map of the longer file was closed before truncating it
+        with self.assertRaises(ValueError):
+            old_map[2 * 80:]
+
+    def test_checkpoint_replaces_branch(self):
+        network = FakeNetwork()
+        b = Blockchain(FakeConfig(self.user_dir), network)
+        block_2 = b.deserialize_header(BLOCK_2.decode('hex'))
+        # a stored branch with more work, but no valid proof of work
+        fake = b.serialize_header(dict(block_2, bits=0x1c00ffff))
+        b.save_chunk(0, (GENESIS + BLOCK_1 + fake).decode('hex'))
+        blockchain.CHECKPOINTS = [(2, b.hash_header(block_2))]
+        self.assertEqual(b.connect_chunk(0, GENESIS + BLOCK_1 + BLOCK_2), 1)
+        self.assertEqual(b.read_raw_header(2), BLOCK_2.decode('hex'))
+        self.assertEqual(network.events, [('reorg', 2)])
+        # a branch that is not checkpointed cannot replace it
+        self.assertFalse(b.save_headers(2, fake.decode('hex')))
+        self.assertEqual(b.read_raw_header(2), BLOCK_2.decode('hex'))
+        # nor can a chunk whose headers lack proof of work
+        self.assertEqual(b.connect_chunk(0, GENESIS + BLOCK_1 + fake), -1)
+        self.assertEqual(b.read_raw_header(2), BLOCK_2.decode('hex'))
+
+    def test_connect_header_most_work(self):
+        network = FakeNetwork()
+        b = Blockchain(FakeConfig(self.user_dir), network)
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH)]
+        block_2 = b.deserialize_header(BLOCK_2.decode('hex'))
+        block_2['block_height'] = 2
+        # a branch with less work at height 2
+        easy = dict(block_2, bits=0x207fffff, nonce=0)
+        b.save_chunk(0, (GENESIS + BLOCK_1 + b.serialize_header(easy)).decode('hex'))
+        self.assertTrue(b.connect_header([], block_2))
+        self.assertEqual(network.events, [('reorg', 2)])
+        self.assertEqual(b.read_raw_header(2), BLOCK_2.decode('hex'))
+        # the same header again changes nothing
+        self.assertTrue(b.connect_header([], block_2))
+        self.assertEqual(network.events, [('reorg', 2)])
+        self.assertEqual(b.read_raw_header(2), BLOCK_2.decode('hex'))
+        # a header that does not connect asks for its parent
+        orphan = dict(block_2, prev_block_hash='00' * 32, block_height=3)
+        self.assertEqual(b.connect_header([], orphan), 2)
+
+    def test_connect_fork_chunk(self):
+        network = FakeNetwork()
+        b = Blockchain(FakeConfig(self.user_dir), network)
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH)]
+        block_1 = b.deserialize_header(BLOCK_1.decode('hex'))
+        block_2 = b.deserialize_header(BLOCK_2.decode('hex'))
+        block_2['block_height'] = 2
+        # our branch has less work from height 1 on
+        easy_1 = dict(block_1, bits=0x207fffff, nonce=0)
+        easy_2 = dict(block_2, prev_block_hash=b.hash_header(easy_1), bits=0x207fffff)
+        b.save_chunk(0, (GENESIS + b.serialize_header(easy_1) + b.serialize_header(easy_2)).decode('hex'))
+        chain = []
+        self.assertEqual(b.connect_header(chain, block_2), 1)
+        # a chunk that forks from the genesis block cannot connect
+        fake_genesis = GENESIS[:-8] + '00000000'
+        self.assertFalse(b.connect_fork_chunk(list(chain), 0, fake_genesis + BLOCK_1))
+        # the fork is found in the chunk, and the branch connected
+        self.assertTrue(b.connect_fork_chunk(chain, 0, GENESIS + BLOCK_1 + BLOCK_2))
+        self.assertEqual(network.events, [('reorg', 1)])
+        self.assertEqual(b.read_raw_headers(0, 3), (GENESIS + BLOCK_1 + BLOCK_2).decode('hex'))
+
+    def test_verify_chunk(self):
+        b = self.blockchain
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH)]
+        chunk = (GENESIS + BLOCK_1 + BLOCK_2).decode('hex')
+        b.verify_chunk(0, chunk)
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, (GENESIS + BLOCK_2).decode('hex'))
+        # a wrong nonce does not give enough work
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, chunk[:-1] + '\0')
+        self.assertEqual(b.connect_chunk(0, chunk.encode('hex')), 1)
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(b.read_raw_header(1), BLOCK_1.decode('hex'))
+
+    def test_verify_checkpointed_chunk(self):
+        b = self.blockchain
+        chunk = (GENESIS + BLOCK_1 + BLOCK_2).decode('hex')
+        blockchain.CHECKPOINTS = [(1, BLOCK_1_HASH), (4031, '00' * 32)]
+        # the headers up to the checkpoint can be stored
+        self.assertEqual(b.verify_chunk(0, chunk), 2)
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, (GENESIS + BLOCK_2).decode('hex'))
+        # the proof of work is checked against the bits of each header
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, chunk[:-1] + '\0')
+        blockchain.CHECKPOINTS = [(1, GENESIS_HASH), (4031, '00' * 32)]
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, chunk)
+        # above the last checkpoint, headers are fully verified
+        blockchain.CHECKPOINTS = [(1, BLOCK_1_HASH)]
+        self.assertEqual(b.verify_chunk(0, chunk), 3)
+        # a checkpoint in the middle of a chunk is checked
+        blockchain.CHECKPOINTS = [(1, GENESIS_HASH)]
+        with self.assertRaises(AssertionError):
+            b.verify_chunk(0, chunk)
+
+    def test_unconfirmed_headers(self):
+        b = self.blockchain
+        blockchain.CHECKPOINTS = [(0, GENESIS_HASH), (2, b.hash_header(
+            b.deserialize_header(BLOCK_2.decode('hex'))))]
+        # block 1 does not lead to a checkpoint yet
+        self.assertEqual(b.connect_chunk(0, GENESIS + BLOCK_1), 1)
+        self.assertEqual(b.height(), 0)
+        self.assertIsNone(b.read_raw_header(1))
+        self.assertEqual(b.read_unconfirmed_header(1), BLOCK_1.decode('hex'))
+        self.assertEqual(b.connect_chunk(0, GENESIS + BLOCK_1 + BLOCK_2), 1)
+        self.assertEqual(b.height(), 2)
+        self.assertEqual(b.read_raw_header(1), BLOCK_1.decode('hex'))
+        self.assertEqual(b.unconfirmed, '')
+
+    def test_target_after_unconfirmed_chunk(self):
+        b = self.blockchain
+        genesis = b.deserialize_header(GENESIS.decode('hex'))
+        data, prev_hash = '', '00' * 32
+        for height in range(2 * 2016):
+            # the retarget period took a week instead of two
+            timestamp = genesis['timestamp'] + (604800 if height == 4031 else 0)
+            header = dict(genesis, prev_block_hash=prev_hash, timestamp=timestamp)
+            data += b.serialize_header(header).decode('hex')
+            prev_hash = b.hash_header(header)
+        # the last checkpoint is in chunk 2, so chunks 0 and 1 are not stored
+        blockchain.CHECKPOINTS = [(5000, '00' * 32)]
+        b.save_chunk(0, data[:2016 * 80], 0)
+        b.save_chunk(1, data[2016 * 80:], 0)
+        self.assertEqual(b.height(), -1)
+        self.assertEqual(b.get_target(2), (0x1c7fff80, 0x7fff80 << 200))
@@ -0,0 +1,73 @@
+import unittest
+import random
+import hashlib
+
+import ecdsa
+from ecdsa.ecdsa import generator_secp256k1
+from ecdsa.util import sigencode_string, number_to_string
+
+from lib import ecc
+from lib.bitcoin import MySigningKey, MyVerifyingKey, SECP256k1
+
+
+class TestEcc(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(42)
+
+    def random_scalars(self, n=20):
+        order = generator_secp256k1.order()
+        return [1, 2, 15, 16, 17, order - 1] + [self.random.randrange(1, order) for i in range(n)]
+
+    def test_mul_G(self):
+        for k in self.random_scalars():
+            P = generator_secp256k1 * k
+            self.assertEqual(ecc.mul_G(k), (P.x(), P.y()))
+        self.assertEqual(ecc.mul_G(0), None)
+        self.assertEqual(ecc.mul_G(ecc.N), None)
+
+    def test_mul_and_add(self):
+        for k in self.random_scalars(10):
+            Q = generator_secp256k1 * self.random.randrange(1, ecc.N)
+            q = (Q.x(), Q.y())
+            P = Q * k
+            self.assertEqual(ecc.mul(q, k), (P.x(), P.y()))
+            P = Q + generator_secp256k1 * k
+            self.assertEqual(ecc.add(q, ecc.mul_G(k)), (P.x(), P.y()))
+            P = Q * k + generator_secp256k1 * (k + 1)
+            self.assertEqual(ecc.mul_add(q, k, k + 1), (P.x(), P.y()))
+        self.assertEqual(ecc.add(ecc.G, ecc.negate(ecc.G)), None)
+        self.assertEqual(ecc.add(ecc.G, ecc.G), ecc.mul_G(2))
+
+    def test_serialization(self):
+        for k in self.random_scalars(5):
+            p = ecc.mul_G(k)
+            self.assertEqual(ecc.ser_to_point(ecc.point_to_ser(p, True)), p)
+            self.assertEqual(ecc.ser_to_point(ecc.point_to_ser(p, False)), p)
+        with self.assertRaises(ValueError):
+            ecc.ser_to_point('\x04' + '\x01' * 64)
+
+    def test_sign_verify_recover(self):
+        for k in self.random_scalars(5):
+            digest = hashlib.sha256(str(k)).digest()
+            z = int(digest.encode('hex'), 16)
+            key = ecdsa.SigningKey.from_secret_exponent(k, curve=SECP256k1)
+            r, s = key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256,
+                                                 sigencode=lambda r, s, order: (r, s))
+            p = ecc.mul_G(k)
+            self.assertTrue(ecc.verify(p, z, r, s))
+            self.assertFalse(ecc.verify(p, z + 1, r, s))
+            self.assertIn(p, [ecc.recover(z, r, s, recid) for recid in range(2)])
+            # MySigningKey gives the same signature as ecdsa, with low s
+            my_key = MySigningKey.from_secret_exponent(k, curve=SECP256k1)
+            sig = my_key.sign_digest_deterministic(digest, hashfunc=hashlib.sha256,
+                                                   sigencode=sigencode_string)
+            self.assertEqual(sig, sigencode_string(r, min(s, ecc.N - s), ecc.N))
+            key.get_verifying_key().verify_digest(sig, digest)
+            for recid in range(2):
+                public_key = MyVerifyingKey.from_signature(sig, recid, digest, curve=SECP256k1)
+                point = public_key.pubkey.point
+                if (point.x(), point.y()) == p:
+                    break
+            else:
+                self.fail("public key not recovered")
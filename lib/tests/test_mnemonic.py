@@ -14,6 +14,21 @@ class Test_NewMnemonic(unittest.TestCase):
                           '741b72fd15effece6bfe5a26a52184f66811bd2be363190e07a42cca442b1a5b'
                           'b22b3ad0eb338197287e6d314866c7fba863ac65d3f156087a5052ebc7157fce')
 
+    def test_pbkdf2_sha512(self):
+        import pbkdf2, hashlib, hmac
+        for password, salt in [('foo', 'bar'), (u'\u00e9t\u00e9', u'electrum\u00e9')]:
+            expected = pbkdf2.PBKDF2(password, salt, iterations=10, macmodule=hmac,
+                                     digestmodule=hashlib.sha512).read(64)
+            self.assertEquals(mnemonic.pbkdf2_sha512(password, salt, 10), expected)
+
+    def test_bip39_to_seed(self):
+        from lib.wallet import BIP44_Wallet
+        words = u' '.join(['abandon'] * 11 + ['about'])
+        seed = BIP44_Wallet.mnemonic_to_seed(words, 'TREZOR')
+        self.assertEquals(seed.encode('hex'),
+                          'c55257c360c07c72029aebc1b53c05ed0362ada38ead3e3e9efa3708e5349553'
+                          '1f09a6987599d18264c1e1c92f2cf141630c7a3c4ab7c81b2f001698e7463b04')
+
     def test_random_seeds(self):
         iters = 10
         m = mnemonic.Mnemonic(lang='en')
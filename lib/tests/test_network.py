@@ -0,0 +1,187 @@
+import time
+import unittest
+from collections import deque
+
+from lib import network
+from lib.network import Network
+
+
+class FakeInterface(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def print_error(self, *msg):
+        pass
+
+
+class FakeBlockchain(object):
+    """Connects the chunks whose data is 'good'"""
+
+    def __init__(self):
+        self.local_height = 0
+        self.connected = []
+
+    def height(self):
+        return self.local_height
+
+    def connect_header(self, chain, header):
+        chain.append(header)
+        return header['block_height'] - 1
+
+    def connect_fork_chunk(self, chain, idx, hexdata):
+        chain.append(hexdata)
+        return idx - 1 if hexdata == 'fork below' else True
+
+    def connect_chunk(self, idx, hexdata):
+        if hexdata != 'good':
+            return idx - 1
+        self.connected.append(idx)
+        self.local_height = idx * 2016 + 2015
+        return idx + 1
+
+
+class ChunkNetwork(Network):
+    """Network with the header download state only, whose requests are
+    recorded instead of being sent"""
+
+    def __init__(self, servers, height):
+        self.blockchain = FakeBlockchain()
+        self.interfaces = dict((s, FakeInterface(s)) for s in servers)
+        self.heights = dict((s, height) for s in servers)
+        self.bc_requests = deque()
+        self.debug = False
+        self.requests = []
+
+    def queue_request(self, method, params, interface=None):
+        self.requests.append((method, params[0], interface.server))
+
+    def notify(self, key):
+        pass
+
+    def switch_lagging_interface(self, server):
+        pass
+
+    def print_error(self, *msg):
+        pass
+
+    def start_download(self, server, height):
+        data = {'if_height': height}
+        self.bc_requests.append((self.interfaces[server], data))
+        self.handle_bc_requests()
+        return data
+
+    def reply(self, data, idx, result='good', error=None):
+        interface = data['pending_chunks'][idx][0]
+        response = {'params': [idx], 'result': result}
+        if error:
+            response['error'] = error
+        self.on_get_chunk(interface, response)
+        return interface.server
+
+
+class TestChunkDownload(unittest.TestCase):
+
+    def test_chunks_are_connected_in_order(self):
+        net = ChunkNetwork(['a', 'b'], 5 * 2016)
+        data = net.start_download('a', 5 * 2016)
+        self.assertEqual(sorted(data['pending_chunks']), range(6))
+        # the chunks are spread over both servers
+        self.assertEqual(set(s for m, idx, s in net.requests), set(['a', 'b']))
+        net.reply(data, 2)
+        net.reply(data, 1)
+        self.assertEqual(net.blockchain.connected, [])
+        self.assertEqual(sorted(data['chunks']), [1, 2])
+        net.reply(data, 0)
+        self.assertEqual(net.blockchain.connected, [0, 1, 2])
+        self.assertEqual(data['chunk_idx'], 3)
+        for idx in [5, 3, 4]:
+            net.reply(data, idx)
+        self.assertEqual(net.blockchain.connected, range(6))
+        self.assertFalse(net.bc_requests)
+
+    def test_window_is_bounded(self):
+        net = ChunkNetwork(['a'], 20 * 2016)
+        data = net.start_download('a', 20 * 2016)
+        self.assertEqual(sorted(data['pending_chunks']), range(network.MAX_PENDING_CHUNKS))
+        net.reply(data, 1)
+        self.assertEqual(len(net.requests), network.MAX_PENDING_CHUNKS)
+        net.reply(data, 0)
+        self.assertEqual(len(net.requests), network.MAX_PENDING_CHUNKS + 2)
+        self.assertEqual(max(data['pending_chunks']), network.MAX_PENDING_CHUNKS + 1)
+
+    def test_timed_out_chunk_moves_to_another_server(self):
+        net = ChunkNetwork(['a', 'b'], 3 * 2016)
+        data = net.start_download('a', 3 * 2016)
+        i, req_time = data['pending_chunks'][1]
+        data['pending_chunks'][1] = i, req_time - network.CHUNK_TIMEOUT - 1
+        net.handle_bc_requests()
+        self.assertEqual(data['failed_chunks'][1], set([i.server]))
+        j, req_time = data['pending_chunks'][1]
+        self.assertNotEqual(i, j)
+        self.assertEqual(net.requests[-1], ('blockchain.block.get_chunk', 1, j.server))
+
+    def test_failed_chunk_is_requested_again(self):
+        net = ChunkNetwork(['a', 'b'], 3 * 2016)
+        data = net.start_download('a', 3 * 2016)
+        net.reply(data, 0)
+        net.reply(data, 2)
+        server = net.reply(data, 1, 'bad')
+        # the previous chunk is requested again, and the failed one
+        # from the other server, while the chunk above it is kept
+        self.assertEqual(data['chunk_idx'], 0)
+        self.assertEqual(data['failed_chunks'][1], set([server]))
+        self.assertEqual(sorted(data['pending_chunks']), [0, 1, 3])
+        self.assertNotEqual(data['pending_chunks'][1][0].server, server)
+        self.assertEqual(sorted(data['chunks']), [2])
+        net.reply(data, 0)
+        net.reply(data, 1)
+        self.assertEqual(net.blockchain.connected, [0, 0, 1, 2])
+        self.assertEqual(data['chunk_idx'], 3)
+
+    def test_failures_are_retried_three_times(self):
+        net = ChunkNetwork(['a'], 2016)
+        data = net.start_download('a', 2016)
+        for retries in range(1, 4):
+            net.reply(data, 1, error='busy')
+            self.assertEqual(data['retries'], retries)
+            self.assertTrue(1 in data['pending_chunks'])
+        net.reply(data, 1, error='busy')
+        self.assertFalse(1 in data['pending_chunks'])
+        net.reply(data, 0)
+        self.assertFalse(net.bc_requests)
+
+    def test_download_survives_the_first_interface(self):
+        net = ChunkNetwork(['a', 'b'], 3 * 2016)
+        data = net.start_download('a', 3 * 2016)
+        net.interfaces.pop('a')
+        net.handle_bc_requests()
+        self.assertEqual(len(net.bc_requests), 1)
+        self.assertEqual(set(i.server for i, t in data['pending_chunks'].values()),
+                         set(['b']))
+        for idx in range(4):
+            net.reply(data, idx)
+        self.assertEqual(net.blockchain.connected, range(4))
+        self.assertFalse(net.bc_requests)
+
+
+class TestForkChunks(unittest.TestCase):
+
+    def test_fork_is_found_with_chunks(self):
+        net = ChunkNetwork(['a'], 5000)
+        net.blockchain.local_height = 5000
+        interface = net.interfaces['a']
+        data = {'if_height': 5001, 'chain': []}
+        net.bc_requests.append((interface, data))
+        net.request_header(interface, data, 5001)
+        # the tip does not connect: its parent's chunk is requested
+        net.on_get_header(interface, {'params': [5001], 'result': {'block_height': 5001}})
+        self.assertEqual(net.requests[-1], ('blockchain.block.get_chunk', 2, 'a'))
+        self.assertEqual(data['fork_chunk'], 2)
+        # the fork is below that chunk
+        net.on_get_chunk(interface, {'params': [2], 'result': 'fork below'})
+        self.assertEqual(net.requests[-1], ('blockchain.block.get_chunk', 1, 'a'))
+        net.on_get_chunk(interface, {'params': [1], 'result': 'fork'})
+        self.assertEqual(len(net.requests), 3)
+        self.assertEqual(data['chain'], [{'block_height': 5001}, 'fork below', 'fork'])
+        self.assertFalse(net.bc_requests)
@@ -9,6 +9,7 @@ import json
 from StringIO import StringIO
 from lib.simple_config import (SimpleConfig, read_system_config,
                                read_user_config)
+from lib.util import get_save_scheduler
 
 
 class Test_SimpleConfig(unittest.TestCase):
@@ -28,6 +29,8 @@ class Test_SimpleConfig(unittest.TestCase):
 
     def tearDown(self):
         super(Test_SimpleConfig, self).tearDown()
+        # Run the config saves scheduled by set_key
+        get_save_scheduler().flush()
         # Remove the temporary directory after each test (to make sure we don't
         # pollute /tmp for nothing.
         shutil.rmtree(self.electrum_dir)
@@ -153,6 +156,21 @@ class Test_SimpleConfig(unittest.TestCase):
         config.set_key("electrum_path", another_path)
         self.assertEqual(another_path, config.get("electrum_path"))
 
+    def test_set_key_is_saved_on_flush(self):
+        fake_read_system = lambda : {}
+        fake_read_user = lambda _: {}
+        read_user_dir = lambda : self.user_dir
+        config = SimpleConfig(options=self.options,
+                              read_system_config_function=fake_read_system,
+                              read_user_config_function=fake_read_user,
+                              read_user_dir_function=read_user_dir)
+        config.set_key("something", "a")
+        config.set_key("other", "b")
+        get_save_scheduler().flush()
+        with open(os.path.join(self.electrum_dir, "config"), "r") as f:
+            result = json.loads(f.read())
+        self.assertEqual({"something": "a", "other": "b"}, result)
+
     def test_user_config_is_not_written_with_read_only_config(self):
         """The user config does not contain command-line options or system
         options when saved."""
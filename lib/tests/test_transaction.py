@@ -1,6 +1,7 @@
 import unittest
 from lib import transaction
-from lib.bitcoin import TYPE_ADDRESS
+from lib import bitcoin
+from lib.bitcoin import TYPE_ADDRESS, TYPE_SCRIPT
 
 import pprint
 
@@ -49,6 +50,123 @@ class TestBCDataStream(unittest.TestCase):
         self.assertEquals(s.read_bytes(4), 'r')
         self.assertEquals(s.read_bytes(1), '')
 
+class TestBinaryCodec(unittest.TestCase):
+
+    def test_compact_size(self):
+        values = [0, 1, 252, 253, 2**16-1, 2**16, 2**32-1, 2**32, 2**64-1]
+        out = bytearray()
+        for v in values:
+            transaction.write_compact_size(out, v)
+        self.assertEquals(str(out).encode('hex'),
+                          '0001fcfdfd00fdfffffe00000100feffffffffff0000000001000000ffffffffffffffffff')
+        offset = 0
+        for v in values:
+            size, offset = transaction.read_compact_size(str(out), offset)
+            self.assertEquals(size, v)
+        self.assertEquals(offset, len(out))
+
+    def test_truncated_tx(self):
+        raw = unsigned_blob.decode('hex')
+        for i in range(len(raw)):
+            with self.assertRaises(transaction.SerializationError):
+                transaction.deserialize_bytes(raw[:i])
+
+    def test_serialize_bytes(self):
+        tx = transaction.Transaction(signed_blob)
+        self.assertEquals(tx.serialize_bytes(), signed_blob.decode('hex'))
+        self.assertEquals(tx.serialize_bytes(0).encode('hex'), tx.tx_for_sig(0))
+
+
+class TestSign(unittest.TestCase):
+
+    def make_tx(self):
+        keypairs = {}
+        inputs = []
+        for i in range(3):
+            sec = bitcoin.SecretToASecret(chr(i + 1) * 32, True)
+            pubkey = bitcoin.public_key_from_private_key(sec)
+            keypairs[pubkey] = sec
+            inputs.append({
+                'prevout_hash': '%064x' % (i + 1),
+                'prevout_n': i,
+                'address': bitcoin.address_from_private_key(sec),
+                'value': 100000,
+                'pubkeys': [pubkey],
+                'x_pubkeys': [pubkey],
+                'signatures': [None],
+                'num_sig': 1,
+            })
+        outputs = [(TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 250000)]
+        return transaction.Transaction.from_io(inputs, outputs), keypairs
+
+    def test_sighash(self):
+        tx, keypairs = self.make_tx()
+        sighash = tx.sighash_function()
+        for i in range(3):
+            self.assertEquals(sighash(i), bitcoin.Hash(tx.serialize_bytes(i)))
+
+    def test_sign(self):
+        tx, keypairs = self.make_tx()
+        tx.sign(keypairs)
+        self.assertTrue(tx.is_complete())
+        tx2, keypairs = self.make_tx()
+        tx2.sign(keypairs, verify=False)
+        self.assertEquals(str(tx2), str(tx))
+        # the signatures are checked again when they are merged
+        tx3, keypairs = self.make_tx()
+        tx3.update_signatures(str(tx))
+        self.assertEquals(str(tx3), str(tx))
+
+    def test_sign_parallel(self):
+        tx, keypairs = self.make_tx()
+        tx.sign(keypairs)
+        tx2, keypairs = self.make_tx()
+        tx2.sign(keypairs, processes=2)
+        self.assertEquals(str(tx2), str(tx))
+
+
+class TestEstimatedSize(unittest.TestCase):
+
+    def make_input(self, i, pubkeys, num_sig=1, p2sh=False):
+        txin = {
+            'prevout_hash': '%064x' % (i + 1),
+            'prevout_n': i,
+            'address': '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs',
+            'pubkeys': pubkeys,
+            'x_pubkeys': pubkeys,
+            'signatures': [None] * len(pubkeys),
+            'num_sig': num_sig,
+        }
+        if p2sh:
+            txin['redeemScript'] = transaction.Transaction.multisig_script(pubkeys, num_sig)
+        return txin
+
+    def test_estimated_size(self):
+        compressed = '02' + '11' * 32
+        uncompressed = '04' + '22' * 64
+        inputs = [
+            self.make_input(0, [compressed]),
+            self.make_input(1, [uncompressed]),
+            self.make_input(2, [None]),
+            self.make_input(3, [compressed, uncompressed, compressed], 2, True),
+            self.make_input(4, [compressed] * 15, 15, True),
+        ]
+        outputs = [
+            (TYPE_ADDRESS, '14CHYaaByjJZpx4oHBpfDMdqhTyXnZ3kVs', 1000),
+            (TYPE_ADDRESS, '3P14159f73E4gFr7JterCCQh9QjiTjiZrG', 2000),
+            (TYPE_SCRIPT, '\x6a' + 'x' * 80, 0),
+        ]
+        for txin in inputs:
+            self.assertEquals(transaction.Transaction.estimated_input_size(txin),
+                              len(transaction.Transaction.serialize_input(txin, -1, -1)) / 2)
+        tx = transaction.Transaction.from_io(inputs, outputs)
+        self.assertEquals(tx.estimated_size(), len(tx.serialize(-1)) / 2)
+        # var_int counts
+        inputs = [self.make_input(i, [compressed]) for i in range(300)]
+        tx = transaction.Transaction.from_io(inputs, outputs * 100)
+        self.assertEquals(tx.estimated_size(), len(tx.serialize(-1)) / 2)
+
+
 class TestTransaction(unittest.TestCase):
 
     def test_tx_unsigned(self):
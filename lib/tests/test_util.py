@@ -1,5 +1,7 @@
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib import util
+from lib.util import format_satoshis, parse_URI, SaveScheduler
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +70,47 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+    def test_save_scheduler_coalesces_saves(self):
+        class Store(object):
+            saves = 0
+            def save(self):
+                self.saves += 1
+        a, b = Store(), Store()
+        scheduler = SaveScheduler(delay=60)
+        for i in range(3):
+            scheduler.schedule(a.save)
+        scheduler.schedule(b.save)
+        scheduler.run_pending(0)
+        self.assertEqual((0, 0), (a.saves, b.saves))
+        scheduler.flush()
+        self.assertEqual((1, 1), (a.saves, b.saves))
+        scheduler.flush()
+        self.assertEqual((1, 1), (a.saves, b.saves))
+
+    def test_save_scheduler_is_not_a_daemon(self):
+        # created from a daemon thread, e.g. by the network
+        created = []
+        thread = threading.Thread(target=lambda: created.append(SaveScheduler(delay=0)))
+        thread.daemon = True
+        thread.start()
+        thread.join()
+        scheduler = created[0]
+        self.assertFalse(scheduler.daemon)
+
+        class Store(object):
+            done = threading.Event()
+            def save(self):
+                self.in_daemon_thread = util.in_daemon_thread()
+                self.done.set()
+        store = Store()
+        saved, util.save_scheduler = util.save_scheduler, scheduler
+        try:
+            scheduler.start()
+            scheduler.schedule(store.save)
+            store.done.wait(5)
+            scheduler.stop()
+            scheduler.join()
+        finally:
+            util.save_scheduler = saved
+        # so the wallet storage writes instead of scheduling itself again
+        self.assertFalse(store.in_daemon_thread)
@@ -2,11 +2,16 @@ import shutil
 import tempfile
 import sys
 import unittest
+import threading
 import os
 import json
+import time
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.wallet import WalletStorage, JournaledWalletStorage, SqliteWalletStorage, SqliteTable, NewWallet
+from lib.wallet import TransactionStore
+from lib.bitcoin import TYPE_ADDRESS
+from lib.util import InvalidPassword
 
 
 class FakeSynchronizer(object):
@@ -18,6 +23,24 @@ class FakeSynchronizer(object):
         self.store.append(address)
 
 
+class FakeTransaction(object):
+
+    def __init__(self, inputs, outputs):
+        self._inputs = [{'address': addr, 'prevout_hash': prevout_hash,
+                         'prevout_n': prevout_n, 'is_coinbase': False}
+                        for addr, prevout_hash, prevout_n in inputs]
+        self._outputs = [(TYPE_ADDRESS, addr, v) for addr, v in outputs]
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def __str__(self):
+        return '00'
+
+
 class WalletTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -65,6 +88,257 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_shared_value_is_written(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txi", {"a": 1})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        txi = storage.share("txi", {})
+        self.assertTrue(txi is storage.borrow("txi"))
+        txi["b"] = 2
+        storage.put("txi", txi)
+        storage.write()
+        self.assertEqual({"a": 1, "b": 2}, WalletStorage(self.wallet_path).get("txi"))
+
+
+    def test_shared_value_that_cannot_be_saved(self):
+        storage = WalletStorage(self.wallet_path)
+        txi = storage.share("txi", {})
+        txi["a"] = set()
+        storage.put("txi", txi)
+        storage.put("b", 1)
+        storage.write()
+        self.assertEqual({"b": 1}, WalletStorage(self.wallet_path).data)
+
+    def test_binary_value_is_saved_as_hex(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("transactions", {"h1": "00ff"})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        raw = storage.share("transactions", {}, binary=True)
+        self.assertEqual({"h1": "\x00\xff"}, raw)
+        raw["h2"] = "\x01"
+        storage.put("transactions", raw)
+        self.assertEqual({"h1": "00ff", "h2": "01"}, storage.get("transactions"))
+        storage.write()
+        self.assertEqual({"h1": "00ff", "h2": "01"}, WalletStorage(self.wallet_path).get("transactions"))
+
+
+class TestJournaledWalletStorage(WalletTestCase):
+
+    def test_changes_are_appended_to_journal(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("txi", {"a": 1, "b": 2})
+        storage.write()
+        self.assertFalse(os.path.exists(storage.journal_path))
+
+        storage.put("txi", {"a": 1, "c": 3})
+        storage.put("labels", {"x": "y"})
+        storage.write()
+        with open(storage.journal_path, "r") as f:
+            entries = map(json.loads, f.read().splitlines()[1:])
+        # values that are not shared are journaled whole
+        self.assertEqual([["put", "txi", {"a": 1, "c": 3}],
+                          ["put", "labels", {"x": "y"}]], entries)
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"a": 1, "c": 3}, storage.get("txi"))
+        self.assertEqual({"x": "y"}, storage.get("labels"))
+
+    def test_shared_changes_are_journaled(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("txi", {"a": 1, "b": 2})
+        storage.write()
+
+        storage = JournaledWalletStorage(self.wallet_path)
+        txi = storage.share("txi", {})
+        self.assertTrue(txi is storage.borrow("txi"))
+        txi["c"] = 3
+        storage.touch("txi", "c")
+        txi.pop("b")
+        storage.touch("txi", "b")
+        storage.put("txi", txi)
+        storage.write()
+        with open(storage.journal_path, "r") as f:
+            entries = map(json.loads, f.read().splitlines()[1:])
+        self.assertEqual([["del", "txi", "b"], ["set", "txi", "c", 3]], sorted(entries))
+        self.assertEqual({"a": 1, "c": 3}, WalletStorage(self.wallet_path).get("txi"))
+
+    def test_binary_changes_are_journaled_as_hex(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("transactions", {"h1": "00"})
+        storage.write()
+
+        storage = JournaledWalletStorage(self.wallet_path)
+        raw = storage.share("transactions", {}, binary=True)
+        raw["h2"] = "\xff"
+        storage.touch("transactions", "h2")
+        storage.put("transactions", raw)
+        storage.write()
+        with open(storage.journal_path, "r") as f:
+            entries = map(json.loads, f.read().splitlines()[1:])
+        self.assertEqual([["set", "transactions", "h2", "ff"]], entries)
+        self.assertEqual({"h1": "00", "h2": "ff"}, WalletStorage(self.wallet_path).get("transactions"))
+
+    def test_shared_item_that_cannot_be_saved(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        txi = storage.share("txi", {})
+        txi["c"] = 3
+        storage.touch("txi", "c")
+        txi["d"] = set()
+        storage.touch("txi", "d")
+        storage.put("txi", txi)
+        storage.write()
+        self.assertEqual({"a": "b", "txi": {"c": 3}}, WalletStorage(self.wallet_path).data)
+
+    def test_journal_is_private(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("seed", "c")
+        storage.write()
+        self.assertEqual(0600, os.stat(storage.journal_path).st_mode & 0777)
+
+    def test_partial_entry_is_discarded(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("c", "d")
+        storage.write()
+        with open(storage.journal_path, "a") as f:
+            f.write('["put", "e", ')
+
+        storage = JournaledWalletStorage(self.wallet_path)
+        self.assertEqual("d", storage.get("c"))
+        self.assertEqual(None, storage.get("e"))
+        # the damaged journal is folded into the wallet file
+        storage.put("e", "f")
+        storage.write()
+        self.assertFalse(os.path.exists(storage.journal_path))
+        self.assertEqual({"a": "b", "c": "d", "e": "f"},
+                         WalletStorage(self.wallet_path).data)
+
+    def test_compaction(self):
+        storage = JournaledWalletStorage(self.wallet_path)
+        storage.min_compaction_size = 0
+        storage.put("a", "b")
+        storage.write()
+        for i in range(10):
+            storage.put("a", "x" * 100 + str(i))
+            storage.write()
+        # the journal outgrew the wallet file, which was rewritten
+        with open(self.wallet_path, "r") as f:
+            self.assertNotEqual({"a": "b"}, json.loads(f.read()))
+        self.assertEqual("x" * 100 + "9", WalletStorage(self.wallet_path).get("a"))
+        storage.compact()
+        self.assertFalse(os.path.exists(storage.journal_path))
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({"a": "x" * 100 + "9"}, json.loads(f.read()))
+
+
+class TestSqliteWalletStorage(WalletTestCase):
+
+    def test_migrate_json_wallet(self):
+        some_dict = {"a": "b", "txo": {"h1": {"addr": [[0, 100, False]]}}}
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps(some_dict))
+
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertTrue(storage.file_exists)
+        self.assertEqual(some_dict, storage.data)
+        self.assertTrue(os.path.exists(self.wallet_path + ".json"))
+
+        # the converted file is recognised by WalletStorage
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(isinstance(storage, SqliteWalletStorage))
+        self.assertEqual(some_dict, storage.data)
+
+    def test_row_level_writes(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        storage.put("txi", {"h1": {}, "h2": {}})
+        storage.put("labels", {"h1": "x"})
+        storage.write()
+        txi = storage.share("txi", {})
+        txi.pop("h2")
+        storage.touch("txi", "h2")
+        txi["h3"] = {"addr": [["h2:0", 5]]}
+        storage.touch("txi", "h3")
+        storage.put("txi", txi)
+        storage.put("labels", None)
+        storage.flush_dirty()
+        self.assertEqual([["del", "txi", "h2"], ["pop", "labels"],
+                          ["set", "txi", "h3", {"addr": [["h2:0", 5]]}]], sorted(storage.pending))
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"txi": {"h1": {}, "h3": {"addr": [["h2:0", 5]]}}}, storage.data)
+
+
+    def test_transactions_are_read_on_demand(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        storage.put("transactions", {"h1": "00", "h2": "01"})
+        storage.write()
+
+        storage = SqliteWalletStorage(self.wallet_path)
+        raw = storage.share("transactions", {})
+        self.assertTrue(isinstance(raw, SqliteTable))
+        self.assertEqual(raw.values, {})
+        self.assertEqual(sorted(raw.keys()), ["h1", "h2"])
+        self.assertEqual(raw["h2"], "01")
+        raw["h3"] = "02"
+        storage.touch("transactions", "h3")
+        raw.pop("h1")
+        storage.touch("transactions", "h1")
+        storage.put("transactions", raw)
+        storage.write()
+        self.assertEqual(raw.values, {})
+        self.assertEqual(raw.get("h3"), "02")
+        self.assertEqual({"h2": "01", "h3": "02"}, storage.get("transactions"))
+        self.assertEqual({"h2": "01", "h3": "02"},
+                         SqliteWalletStorage(self.wallet_path).get("transactions"))
+
+        storage = SqliteWalletStorage(self.wallet_path)
+        raw = storage.share("transactions", {}, binary=True)
+        self.assertEqual(raw["h2"], "\x01")
+        raw["h4"] = "\xff"
+        storage.touch("transactions", "h4")
+        storage.put("transactions", raw)
+        storage.write()
+        self.assertEqual({"h2": "01", "h3": "02", "h4": "ff"},
+                         SqliteWalletStorage(self.wallet_path).get("transactions"))
+
+
+class TestTransactionStore(unittest.TestCase):
+
+    signed_blob = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+
+    def test_transactions_are_parsed_on_demand(self):
+        raw = dict(('%064x' % i, self.signed_blob.decode('hex')) for i in range(5))
+        store = TransactionStore(raw, threading.RLock())
+        store.max_cached = 2
+        self.assertEqual(len(store.cache), 0)
+        tx = store['%064x' % 0]
+        self.assertEqual(tx.outputs()[0][2], 1000000)
+        self.assertTrue(store.get('%064x' % 0) is tx)
+        for i in range(1, 5):
+            store.get('%064x' % i)
+        self.assertEqual(store.cache.keys(), ['%064x' % 3, '%064x' % 4])
+        self.assertEqual(str(store.pop('%064x' % 4)), self.signed_blob)
+        self.assertEqual(store.cache.keys(), ['%064x' % 3])
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.get('%064x' % 4), None)
+        store['%064x' % 4] = tx
+        self.assertEqual(raw['%064x' % 4], self.signed_blob.decode('hex'))
+        store.discard('%064x' % 4)
+        store.discard('%064x' % 4)
+        self.assertEqual(store.cache.keys(), ['%064x' % 3])
+        self.assertFalse('%064x' % 4 in store)
+
 
 class TestNewWallet(WalletTestCase):
 
@@ -108,3 +382,203 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def test_unlocked_keys_expire(self):
+        self.wallet.synchronize()
+        account = self.wallet.default_account()
+        x_pubkey = account.get_xpubkeys(0, 3)[0]
+        expected = self.wallet.get_private_key(account.get_address(0, 3), self.password)[0]
+        with self.wallet.unlock(self.password) as context:
+            sec = self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password, context)
+        self.assertEqual(sec, expected)
+        self.assertEqual(self.wallet.unlocked_keys, {})
+        self.wallet.unlock_ttl = 60
+        with self.wallet.unlock(self.password) as context:
+            self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password, context)
+        self.assertEqual(len(self.wallet.unlocked_keys), 1)
+        name = self.wallet.unlocked_keys.keys()[0]
+        with self.wallet.unlock(self.password) as context:
+            sec = self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password, context)
+            self.assertEqual(context.secrets, {})
+        self.assertEqual(sec, expected)
+        # while keys are unlocked, the master key is not decrypted
+        check_password = self.wallet.check_password
+        def decrypt(password):
+            self.assertNotEqual(password, self.password)
+            check_password(password)
+        self.wallet.check_password = decrypt
+        with self.wallet.unlock(self.password) as context:
+            self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password, context)
+        with self.assertRaises(InvalidPassword):
+            self.wallet.unlock("wrong")
+        del self.wallet.check_password
+        self.wallet.unlocked_until = time.time() - 1
+        self.assertIsNone(self.wallet.get_unlocked_key(name))
+        self.assertEqual(self.wallet.unlocked_keys, {})
+        # the keys are forgotten without being used again
+        self.wallet.unlock_ttl = 0.1
+        with self.wallet.unlock(self.password) as context:
+            self.wallet.get_private_key_from_xpubkey(x_pubkey, self.password, context)
+        self.assertEqual(len(self.wallet.unlocked_keys), 1)
+        timer = self.wallet.unlock_timer
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertEqual(self.wallet.unlocked_keys, {})
+        self.assertIsNone(self.wallet.unlock_timer)
+        self.assertIsNone(self.wallet.unlock_verifier)
+
+    def test_balance_cache_follows_history(self):
+        address = self.wallet.create_new_address()
+        tx_hash = '11' * 32
+        tx = FakeTransaction([(None, '22' * 32, 0)], [(address, 100000)])
+        self.assertEqual(self.wallet.get_addr_balance(address), (0, 0, 0))
+        self.wallet.receive_tx_callback(tx_hash, tx, 0)
+        self.wallet.receive_history_callback(address, [(tx_hash, 0)], {})
+        self.assertEqual(self.wallet.get_addr_balance(address), (0, 100000, 0))
+        self.assertEqual(len(self.wallet.get_addr_utxo(address)), 1)
+        self.wallet.receive_history_callback(address, [(tx_hash, 10)], {})
+        self.assertEqual(self.wallet.get_addr_balance(address), (100000, 0, 0))
+        self.wallet.receive_history_callback(address, [], {})
+        self.assertEqual(self.wallet.get_addr_balance(address), (0, 0, 0))
+        self.assertEqual(self.wallet.get_addr_utxo(address), [])
+
+    def test_remove_transaction_undoes_spends(self):
+        address = self.wallet.create_new_address()
+        funding_hash, spending_hash = '11' * 32, '33' * 32
+        funding = FakeTransaction([(None, '22' * 32, 0)], [(address, 100000)])
+        spending = FakeTransaction([(address, funding_hash, 0)], [(None, 90000)])
+        self.wallet.add_transaction(funding_hash, funding)
+        self.wallet.add_transaction(spending_hash, spending)
+        ser = funding_hash + ':0'
+        self.assertEqual(self.wallet.txi[spending_hash], {address: [(ser, 100000)]})
+        self.assertEqual(self.wallet.pruned_txo, {})
+        self.wallet.remove_transaction(funding_hash)
+        self.assertEqual(self.wallet.txi[spending_hash], {})
+        self.assertEqual(self.wallet.pruned_txo, {ser: spending_hash})
+        self.wallet.add_transaction(funding_hash, funding)
+        self.assertEqual(self.wallet.txi[spending_hash], {address: [(ser, 100000)]})
+        self.wallet.remove_transaction(spending_hash)
+        self.assertEqual(self.wallet.pruned_txo, {})
+        self.assertEqual(self.wallet.spent_by, {})
+        self.assertEqual(self.wallet.pruned_by_tx, {})
+
+    def test_history_is_updated_incrementally(self):
+        address = self.wallet.create_new_address()
+        funding_hash, spending_hash = '11' * 32, '33' * 32
+        funding = FakeTransaction([(None, '22' * 32, 0)], [(address, 100000)])
+        spending = FakeTransaction([(address, funding_hash, 0)], [(address, 90000)])
+        self.wallet.receive_tx_callback(funding_hash, funding, 10)
+        self.wallet.receive_history_callback(address, [(funding_hash, 10)], {})
+        self.assertEqual(self.wallet.get_history(),
+                         [(funding_hash, 10, 0, False, 100000, 100000)])
+        self.wallet.receive_tx_callback(spending_hash, spending, 0)
+        self.wallet.receive_history_callback(address, [(funding_hash, 10), (spending_hash, 0)], {})
+        self.assertEqual(self.wallet.get_history(),
+                         [(funding_hash, 10, 0, False, 100000, 100000),
+                          (spending_hash, 0, 0, False, -10000, 90000)])
+        self.assertEqual(self.wallet.get_history(count=1),
+                         [(spending_hash, 0, 0, False, -10000, 90000)])
+        self.assertEqual(self.wallet.get_history(offset=1),
+                         [(funding_hash, 10, 0, False, 100000, 100000)])
+        self.assertEqual(self.wallet.get_history(to_height=10),
+                         [(funding_hash, 10, 0, False, 100000, 100000)])
+        self.assertEqual(self.wallet.get_history(from_height=11),
+                         [(spending_hash, 0, 0, False, -10000, 90000)])
+        # the spending tx gets confirmed before the funding one
+        self.wallet.receive_history_callback(address, [(funding_hash, 10), (spending_hash, 5)], {})
+        self.assertEqual([h[0] for h in self.wallet.get_history()],
+                         [spending_hash, funding_hash])
+
+    def test_history_is_filtered_by_domain(self):
+        first = self.wallet.create_new_address()
+        funding_hash = '11' * 32
+        self.wallet.receive_tx_callback(funding_hash, FakeTransaction([(None, '22' * 32, 0)], [(first, 100000)]), 10)
+        self.wallet.receive_history_callback(first, [(funding_hash, 10)], {})
+        self.wallet.get_history()
+        index = self.wallet.history_index
+        # a new address extends the wallet index instead of rebuilding it
+        second = self.wallet.create_new_address()
+        spending_hash = '33' * 32
+        spending = FakeTransaction([(first, funding_hash, 0)], [(second, 90000)])
+        self.wallet.receive_tx_callback(spending_hash, spending, 11)
+        self.wallet.receive_history_callback(first, [(funding_hash, 10), (spending_hash, 11)], {})
+        self.wallet.receive_history_callback(second, [(spending_hash, 11)], {})
+        self.assertEqual(self.wallet.get_history(),
+                         [(funding_hash, 10, 0, False, 100000, 100000),
+                          (spending_hash, 11, 0, False, -10000, 90000)])
+        self.assertIs(self.wallet.history_index, index)
+        self.assertEqual(self.wallet.get_history([second]),
+                         [(spending_hash, 11, 0, False, 90000, 90000)])
+        self.assertEqual(self.wallet.get_history([first], count=1),
+                         [(spending_hash, 11, 0, False, -100000, 0)])
+
+    def test_history_page_does_not_scan_addresses(self):
+        address = self.wallet.create_new_address()
+        funding_hash = '11' * 32
+        self.wallet.receive_tx_callback(funding_hash, FakeTransaction([(None, '22' * 32, 0)], [(address, 100000)]), 10)
+        self.wallet.receive_history_callback(address, [(funding_hash, 10)], {})
+        self.wallet.get_history()
+        # the wallet balance comes from the index, whose addresses are unchanged
+        def fail(*args):
+            raise AssertionError
+        self.wallet.addresses = self.wallet.get_balance = fail
+        self.assertEqual(self.wallet.get_history(count=1),
+                         [(funding_hash, 10, 0, False, 100000, 100000)])
+
+    def test_synchronize_extends_gap(self):
+        self.wallet.synchronize()
+        account = self.wallet.default_account()
+        self.assertEqual(len(account.get_addresses(0)), 20)
+        self.assertEqual(len(account.get_addresses(1)), 6)
+        self.wallet.stored_height = 100
+        self.wallet.history[account.get_address(0, 4)] = [('11' * 32, 10)]
+        self.wallet.synchronize()
+        self.assertEqual(len(account.get_addresses(0)), 25)
+        self.assertEqual(len(account.get_addresses(1)), 6)
+
+    def test_restore_window_is_trimmed(self):
+        self.wallet.start_restore(50)
+        self.wallet.synchronize()
+        account = self.wallet.default_account()
+        self.assertEqual(len(account.get_addresses(0)), 50)
+        self.assertEqual(len(account.get_addresses(1)), 50)
+        self.wallet.stored_height = 100
+        self.wallet.history[account.get_address(0, 30)] = [('11' * 32, 10)]
+        # the window has not been extended yet
+        self.assertFalse(self.wallet.finish_restore())
+        self.wallet.synchronize()
+        self.assertEqual(len(account.get_addresses(0)), 81)
+        last = account.get_address(0, 80)
+        self.assertTrue(self.wallet.finish_restore())
+        self.assertEqual(self.wallet.restore_window, 0)
+        self.assertEqual(len(account.get_addresses(0)), 51)
+        self.assertEqual(len(account.get_addresses(1)), 6)
+        self.assertEqual(len(self.wallet.addresses(True)), 57)
+        self.assertTrue(self.wallet.is_mine(account.get_address(0, 50)))
+        self.assertFalse(self.wallet.is_mine(last))
+        self.assertFalse(last in self.wallet.history)
+        # the server still notifies the trimmed addresses
+        self.wallet.receive_history_callback(last, [('22' * 32, 20)], {})
+        self.assertFalse(last in self.wallet.history)
+        self.assertFalse('22' * 32 in self.wallet.tx_addr_hist)
+        self.assertEqual(self.wallet.get_unverified_txs(), {})
+
+    def test_restore_window_follows_unconfirmed_history(self):
+        self.wallet.start_restore(50)
+        self.wallet.synchronize()
+        account = self.wallet.default_account()
+        self.wallet.stored_height = 100
+        # the last transaction has a single confirmation
+        self.wallet.history[account.get_address(0, 30)] = [('11' * 32, 100)]
+        self.wallet.synchronize()
+        self.assertEqual(len(account.get_addresses(0)), 81)
+        self.assertTrue(self.wallet.finish_restore())
+        self.assertEqual(len(account.get_addresses(0)), 51)
+
+    def test_undo_verifications(self):
+        self.wallet.verified_tx['11' * 32] = (100, 0, 1)
+        self.wallet.verified_tx['22' * 32] = (101, 0, 1)
+        self.assertEqual(self.wallet.undo_verifications(101), ['22' * 32])
+        self.assertEqual(self.wallet.verified_tx.keys(), ['11' * 32])
+        self.assertEqual(self.wallet.get_unverified_txs(), {'22' * 32: 101})
+        self.assertEqual(self.wallet.undo_verifications(102), [])
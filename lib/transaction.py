@@ -421,13 +421,59 @@ def get_address_from_output_script(bytes):
 
 
 
-def parse_input(vds):
+def read_bytes(raw, offset, size):
+    if offset + size > len(raw):
+        raise SerializationError("attempt to read past end of buffer")
+    return raw[offset:offset+size], offset + size
+
+
+def unpack_from(fmt, raw, offset):
+    if offset + struct.calcsize(fmt) > len(raw):
+        raise SerializationError("attempt to read past end of buffer")
+    return struct.unpack_from(fmt, raw, offset)
+
+
+def read_compact_size(raw, offset):
+    (size,) = unpack_from('<B', raw, offset)
+    offset += 1
+    if size == 253:
+        (size,) = unpack_from('<H', raw, offset)
+        offset += 2
+    elif size == 254:
+        (size,) = unpack_from('<I', raw, offset)
+        offset += 4
+    elif size == 255:
+        (size,) = unpack_from('<Q', raw, offset)
+        offset += 8
+    return size, offset
+
+
+def write_compact_size(out, size):
+    if size < 0:
+        raise SerializationError("attempt to write size < 0")
+    elif size < 253:
+        out.append(size)
+    elif size < 2**16:
+        out += '\xfd' + struct.pack('<H', size)
+    elif size < 2**32:
+        out += '\xfe' + struct.pack('<I', size)
+    else:
+        out += '\xff' + struct.pack('<Q', size)
+
+
+def read_script(raw, offset):
+    size, offset = read_compact_size(raw, offset)
+    return read_bytes(raw, offset, size)
+
+
+def parse_input(raw, offset):
     d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
+    prevout_hash, offset = read_bytes(raw, offset, 32)
+    prevout_hash = hash_encode(prevout_hash)
+    (prevout_n,) = unpack_from('<I', raw, offset)
+    scriptSig, offset = read_script(raw, offset + 4)
+    (sequence,) = unpack_from('<I', raw, offset)
     d['scriptSig'] = scriptSig.encode('hex')
-    sequence = vds.read_uint32()
     if prevout_hash == '00'*32:
         d['is_coinbase'] = True
     else:
@@ -440,37 +486,68 @@ def parse_input(vds):
         d['address'] = None
         if scriptSig:
             parse_scriptSig(d, scriptSig)
-    return d
+    return d, offset + 4
 
 
-def parse_output(vds, i):
+def parse_output(raw, offset, i):
     d = {}
-    d['value'] = vds.read_int64()
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    (d['value'],) = unpack_from('<q', raw, offset)
+    scriptPubKey, offset = read_script(raw, offset + 8)
     d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
     d['scriptPubKey'] = scriptPubKey.encode('hex')
     d['prevout_n'] = i
-    return d
+    return d, offset
 
 
-def deserialize(raw):
-    vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+def deserialize_bytes(raw):
     d = {}
-    start = vds.read_cursor
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    d['inputs'] = list(parse_input(vds) for i in xrange(n_vin))
-    n_vout = vds.read_compact_size()
-    d['outputs'] = list(parse_output(vds,i) for i in xrange(n_vout))
-    d['lockTime'] = vds.read_uint32()
+    (d['version'],) = unpack_from('<i', raw, 0)
+    n_vin, offset = read_compact_size(raw, 4)
+    d['inputs'] = []
+    for i in xrange(n_vin):
+        txin, offset = parse_input(raw, offset)
+        d['inputs'].append(txin)
+    n_vout, offset = read_compact_size(raw, offset)
+    d['outputs'] = []
+    for i in xrange(n_vout):
+        txout, offset = parse_output(raw, offset, i)
+        d['outputs'].append(txout)
+    (d['lockTime'],) = unpack_from('<I', raw, offset)
     return d
 
 
+def deserialize(raw):
+    return deserialize_bytes(raw.decode('hex'))
+
+
 def push_script(x):
     return op_push(len(x)/2) + x
 
 
+def push_size(n):
+    "size of a script pushing n bytes, see op_push"
+    if n < 0x4c:
+        return 1 + n
+    elif n < 0xff:
+        return 2 + n
+    elif n < 0xffff:
+        return 3 + n
+    else:
+        return 5 + n
+
+
+def var_int_size(i):
+    "size of var_int(i)"
+    if i < 0xfd:
+        return 1
+    elif i <= 0xffff:
+        return 3
+    elif i <= 0xffffffff:
+        return 5
+    else:
+        return 9
+
+
 class Transaction:
 
     def __str__(self):
@@ -509,13 +586,14 @@ class Transaction:
     def update_signatures(self, raw):
         """Add new signatures to a transaction"""
         d = deserialize(raw)
+        sighash = self.sighash_function()
         for i, txin in enumerate(self.inputs()):
             sigs1 = txin.get('signatures')
             sigs2 = d['inputs'][i].get('signatures')
             for sig in sigs2:
                 if sig in sigs1:
                     continue
-                for_sig = Hash(self.tx_for_sig(i).decode('hex'))
+                for_sig = sighash(i)
                 # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(sig.decode('hex'), order)
@@ -664,16 +742,20 @@ class Transaction:
         return script
 
     @classmethod
-    def serialize_input(self, txin, i, for_sig):
+    def write_input(self, out, txin, script):
         # Prev hash and index
-        s = txin['prevout_hash'].decode('hex')[::-1].encode('hex')
-        s += int_to_hex(txin['prevout_n'], 4)
+        out += txin['prevout_hash'].decode('hex')[::-1]
+        out += struct.pack('<I', txin['prevout_n'])
         # Script length, script, sequence
-        script = self.input_script(txin, i, for_sig)
-        s += var_int(len(script)/2)
-        s += script
-        s += int_to_hex(txin.get('sequence', 0xffffffff), 4)
-        return s
+        write_compact_size(out, len(script))
+        out += script
+        out += struct.pack('<I', txin.get('sequence', 0xffffffff))
+
+    @classmethod
+    def serialize_input(self, txin, i, for_sig):
+        out = bytearray()
+        self.write_input(out, txin, self.input_script(txin, i, for_sig).decode('hex'))
+        return str(out).encode('hex')
 
     def set_sequence(self, n):
         for txin in self.inputs():
@@ -684,24 +766,61 @@ class Transaction:
         self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         self._outputs.sort(key = lambda o: (o[2], self.pay_script(o[0], o[1])))
 
-    def serialize(self, for_sig=None):
+    def serialize_bytes(self, for_sig=None):
         inputs = self.inputs()
         outputs = self.outputs()
-        s = int_to_hex(1, 4)                                         # version
-        s += var_int(len(inputs))                                    # number of inputs
+        out = bytearray(struct.pack('<i', 1))                        # version
+        write_compact_size(out, len(inputs))                         # number of inputs
         for i, txin in enumerate(inputs):
-            s += self.serialize_input(txin, i, for_sig)
-        s += var_int(len(outputs))                                   # number of outputs
+            script = self.input_script(txin, i, for_sig).decode('hex')
+            self.write_input(out, txin, script)
+        self.write_outputs(out, outputs)
+        out += struct.pack('<I', self.locktime)                      # locktime
+        if for_sig is not None and for_sig != -1:
+            out += struct.pack('<I', 1)                              # hash type
+        return str(out)
+
+    def write_outputs(self, out, outputs):
+        write_compact_size(out, len(outputs))                        # number of outputs
         for output in outputs:
             output_type, addr, amount = output
-            s += int_to_hex(amount, 8)                               # amount
-            script = self.pay_script(output_type, addr)
-            s += var_int(len(script)/2)                              #  script length
-            s += script                                              #  script
-        s += int_to_hex(self.locktime, 4)                            #  locktime
-        if for_sig is not None and for_sig != -1:
-            s += int_to_hex(1, 4)                                    #  hash type
-        return s
+            out += struct.pack('<q', amount)                         # amount
+            script = self.pay_script(output_type, addr).decode('hex')
+            write_compact_size(out, len(script))                     # script length
+            out += script                                            # script
+
+    def sighash_function(self):
+        """Return a function that computes the signature hash of an
+        input, like Hash(self.serialize_bytes(i)). Only the signed input
+        is serialized for each call, the rest of the preimage is
+        serialized once."""
+        inputs = self.inputs()
+        head = bytearray(struct.pack('<i', 1))
+        write_compact_size(head, len(inputs))
+        # the other inputs are serialized with an empty script
+        blank = bytearray()
+        offsets = [0]
+        for txin in inputs:
+            self.write_input(blank, txin, '')
+            offsets.append(len(blank))
+        head, blank = str(head), str(blank)
+        tail = bytearray()
+        self.write_outputs(tail, self.outputs())
+        tail += struct.pack('<I', self.locktime)
+        tail += struct.pack('<I', 1)
+        tail = str(tail)
+        def sighash(i):
+            txin = inputs[i]
+            out = bytearray(head)
+            out += blank[:offsets[i]]
+            self.write_input(out, txin, self.input_script(txin, i, i).decode('hex'))
+            out += blank[offsets[i+1]:]
+            out += tail
+            return Hash(str(out))
+        return sighash
+
+    def serialize(self, for_sig=None):
+        return self.serialize_bytes(for_sig).encode('hex')
 
     def tx_for_sig(self,i):
         return self.serialize(for_sig = i)
@@ -729,15 +848,37 @@ class Transaction:
     def is_final(self):
         return not any([x.get('sequence', 0xffffffff) < 0xffffffff - 1 for x in self.inputs()])
 
-    @profiler
     def estimated_size(self):
-        '''Return an estimated tx size in bytes.'''
-        return len(self.serialize(-1)) / 2  # ASCII hex string
+        '''Return an estimated tx size in bytes.  This is the size of
+        serialize(-1), computed without serializing the tx.'''
+        inputs = self.inputs()
+        outputs = self.outputs()
+        size = 8 + var_int_size(len(inputs)) + var_int_size(len(outputs))
+        size += sum(self.estimated_input_size(txin) for txin in inputs)
+        for output_type, addr, amount in outputs:
+            if output_type == TYPE_SCRIPT:
+                script_size = len(addr)
+            else:
+                script_size = len(self.pay_script(output_type, addr)) / 2
+            size += 8 + var_int_size(script_size) + script_size
+        return size
 
     @classmethod
     def estimated_input_size(self, txin):
         '''Return an estimated of serialized input size in bytes.'''
-        return len(self.serialize_input(txin, -1, -1)) / 2
+        # see input_script: signatures are assumed to be 0x48 bytes long
+        p2sh = txin.get('redeemScript') is not None
+        num_sig = txin['num_sig'] if p2sh else 1
+        script_size = num_sig * push_size(0x48)
+        if not p2sh:
+            x_pubkey = txin['pubkeys'][0]
+            # an address without pubkey is written as 'fd' + addrtype + hash160
+            script_size += push_size(len(x_pubkey) / 2 if x_pubkey is not None else 22)
+        else:
+            # op_0, then op_m, pubkeys, op_n, op_checkmultisig
+            redeem_script_size = 3 + sum(push_size(len(k) / 2) for k in txin['pubkeys'])
+            script_size += 1 + push_size(redeem_script_size)
+        return 40 + var_int_size(script_size) + script_size
 
     def signature_count(self):
         r = 0
@@ -779,35 +920,41 @@ class Transaction:
                 out.add(x_pubkey)
         return out
 
-    def sign(self, keypairs):
+    def sign(self, keypairs, verify=True, processes=None):
+        """Sign the inputs for which keypairs has a key. If processes is
+        more than 1, the signatures are computed by a pool of that many
+        processes; signatures are deterministic, so the result is the
+        same."""
+        sighash = self.sighash_function()
+        # (input index, x_pubkey) of each signature to add
+        todo = []
+        items = []
         for i, txin in enumerate(self.inputs()):
             num = txin['num_sig']
+            count = len(filter(None, txin['signatures']))
+            for_sig = None
             for x_pubkey in txin['x_pubkeys']:
-                signatures = filter(None, txin['signatures'])
-                if len(signatures) == num:
+                if count == num:
                     # txin is complete
                     break
-                if x_pubkey in keypairs.keys():
+                if x_pubkey in keypairs:
                     print_error("adding signature for", x_pubkey)
-                    # add pubkey to txin
-                    txin = self._inputs[i]
-                    x_pubkeys = txin['x_pubkeys']
-                    ii = x_pubkeys.index(x_pubkey)
-                    sec = keypairs[x_pubkey]
-                    pubkey = public_key_from_private_key(sec)
-                    txin['x_pubkeys'][ii] = pubkey
-                    txin['pubkeys'][ii] = pubkey
-                    self._inputs[i] = txin
-                    # add signature
-                    for_sig = Hash(self.tx_for_sig(i).decode('hex'))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent( secexp, curve = SECP256k1 )
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
-                    assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
-                    txin['signatures'][ii] = sig.encode('hex')
-                    self._inputs[i] = txin
+                    if for_sig is None:
+                        for_sig = sighash(i)
+                    todo.append((i, x_pubkey))
+                    items.append((keypairs[x_pubkey], for_sig))
+                    count += 1
+        if processes > 1 and len(items) > 1:
+            results = sign_digests_parallel(items, verify, processes)
+        else:
+            results = sign_digests(items, verify)
+        for (i, x_pubkey), (pubkey, sig) in zip(todo, results):
+            txin = self._inputs[i]
+            ii = txin['x_pubkeys'].index(x_pubkey)
+            # add pubkey and signature to txin
+            txin['x_pubkeys'][ii] = pubkey
+            txin['pubkeys'][ii] = pubkey
+            txin['signatures'][ii] = sig
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
@@ -848,7 +995,7 @@ class Transaction:
         # see https://en.bitcoin.it/wiki/Transaction_fees
         #
         # size must be smaller than 1 kbyte for free tx
-        size = len(self.serialize(-1))/2
+        size = self.estimated_size()
         if size >= 10000:
             return True
         # all outputs must be 0.01 BTC or larger for free tx
@@ -868,6 +1015,45 @@ class Transaction:
 
 
 
+def sign_digests(items, verify=True):
+    """Sign a list of (private key, digest) and return the list of
+    (pubkey, signature). Each key is parsed once."""
+    signers = {}
+    out = []
+    for sec, for_sig in items:
+        if sec not in signers:
+            pkey = regenerate_key(sec)
+            private_key = bitcoin.MySigningKey.from_secret_exponent(pkey.secret, curve = SECP256k1)
+            signers[sec] = public_key_from_private_key(sec), private_key
+        pubkey, private_key = signers[sec]
+        sig = private_key.sign_digest_deterministic( for_sig, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der )
+        if verify:
+            public_key = private_key.get_verifying_key()
+            assert public_key.verify_digest( sig, for_sig, sigdecode = ecdsa.util.sigdecode_der)
+        out.append((pubkey, sig.encode('hex')))
+    return out
+
+
+def _sign_digests(args):
+    return sign_digests(*args)
+
+
+def sign_digests_parallel(items, verify, processes):
+    """Like sign_digests, using a pool of processes. The pool only lives
+    for the duration of the call, so keys do not outlive it."""
+    import multiprocessing
+    n = min(processes, len(items))
+    chunks = [items[k::n] for k in range(n)]
+    pool = multiprocessing.Pool(n)
+    try:
+        results = pool.map(_sign_digests, [(chunk, verify) for chunk in chunks])
+    finally:
+        pool.terminate()
+        pool.join()
+    # item j was signed by process j % n
+    return [results[j % n][j / n] for j in range(len(items))]
+
+
 def tx_from_str(txt):
     "json or raw hexadecimal"
     import json
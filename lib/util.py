@@ -157,6 +157,76 @@ class DaemonThread(threading.Thread, PrintError):
         self.print_error("stopped")
 
 
+class SaveScheduler(DaemonThread):
+    """Runs the save functions of modified objects from a background
+    thread.  Several changes made to an object within `delay` seconds
+    result in a single save.  Pending saves are run when the main
+    thread exits, or when flush() is called.
+    """
+
+    def __init__(self, delay=2.0):
+        DaemonThread.__init__(self)
+        # outlive the thread that happened to create us, and do not
+        # inherit its daemon flag: pending saves must run at exit
+        self.parent_thread = [t for t in threading.enumerate()
+                              if isinstance(t, threading._MainThread)][0]
+        self.daemon = False
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = {}
+
+    def schedule(self, save):
+        """Schedule a call to save, which must be a bound method."""
+        key = (id(save.im_self), save.__name__)
+        with self.cond:
+            if key not in self.pending:
+                self.pending[key] = (time.time() + self.delay, save)
+
+    def flush(self):
+        """Run every pending save now, in the calling thread."""
+        self.run_pending(None)
+
+    def run_pending(self, now):
+        with self.cond:
+            keys = [k for k, (t, save) in self.pending.items()
+                    if now is None or t <= now]
+            saves = [self.pending.pop(k)[1] for k in keys]
+        for save in saves:
+            try:
+                save()
+            except:
+                traceback.print_exc(file=sys.stderr)
+
+    def run(self):
+        while self.is_running():
+            with self.cond:
+                deadlines = [t for t, save in self.pending.values()]
+            timeout = min(deadlines + [time.time() + 0.5]) - time.time()
+            if timeout > 0:
+                with self.cond:
+                    self.cond.wait(timeout)
+            self.run_pending(time.time())
+        self.flush()
+        self.on_stop()
+
+save_scheduler = None
+save_scheduler_lock = threading.Lock()
+
+def get_save_scheduler():
+    global save_scheduler
+    with save_scheduler_lock:
+        if save_scheduler is None or not save_scheduler.is_alive():
+            save_scheduler = SaveScheduler()
+            save_scheduler.start()
+        return save_scheduler
+
+def in_daemon_thread():
+    """True in daemon threads, which may be killed while writing a file.
+    The save scheduler is not one of them."""
+    thread = threading.currentThread()
+    return thread is not save_scheduler and thread.isDaemon()
+
+
 is_verbose = False
 def set_verbosity(b):
     global is_verbose
@@ -627,6 +697,7 @@ class StoreDict(dict):
     def __init__(self, config, name):
         self.config = config
         self.path = os.path.join(self.config.path, name)
+        self.lock = threading.RLock()
         self.load()
 
     def load(self):
@@ -637,18 +708,21 @@ class StoreDict(dict):
             pass
 
     def save(self):
-        with open(self.path, 'w') as f:
+        with self.lock:
             s = json.dumps(self, indent=4, sort_keys=True)
+        with open(self.path, 'w') as f:
             r = f.write(s)
 
     def __setitem__(self, key, value):
-        dict.__setitem__(self, key, value)
-        self.save()
+        with self.lock:
+            dict.__setitem__(self, key, value)
+        get_save_scheduler().schedule(self.save)
 
     def pop(self, key):
         if key in self.keys():
-            dict.pop(self, key)
-            self.save()
+            with self.lock:
+                dict.pop(self, key)
+            get_save_scheduler().schedule(self.save)
 
 
 
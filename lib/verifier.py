@@ -37,6 +37,7 @@ class SPV(ThreadJob):
         # Keyed by tx hash.  Value is None if the merkle branch was
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
+        network.register_callback(self.on_reorg, ['reorg'])
 
     def run(self):
         lh = self.network.get_local_height()
@@ -85,6 +86,9 @@ class SPV(ThreadJob):
         return hash_encode(h)
 
 
+    def on_reorg(self, event, height):
+        self.undo_verifications(height)
+
     def undo_verifications(self, height):
         tx_hashes = self.wallet.undo_verifications(height)
         for tx_hash in tx_hashes:
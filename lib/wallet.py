@@ -25,6 +25,7 @@
 
 import os
 import hashlib
+import hmac
 import ast
 import threading
 import random
@@ -35,10 +36,11 @@ import re
 import stat
 from functools import partial
 from unicodedata import normalize
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
+from bisect import bisect_left
 
 from i18n import _
-from util import NotEnoughFunds, PrintError, profiler
+from util import NotEnoughFunds, PrintError, profiler, get_save_scheduler, in_daemon_thread
 
 from bitcoin import *
 from account import *
@@ -50,7 +52,7 @@ import bitcoin
 import coinchooser
 from synchronizer import Synchronizer
 from verifier import SPV
-from mnemonic import Mnemonic
+from mnemonic import Mnemonic, pbkdf2_sha512
 
 import paymentrequest
 
@@ -69,15 +71,27 @@ TX_STATUS = [
 
 class WalletStorage(PrintError):
 
+    def __new__(cls, path):
+        # wallets converted to sqlite are opened with the sqlite engine
+        if path and is_sqlite_file(path):
+            cls = SqliteWalletStorage
+        return PrintError.__new__(cls)
+
     def __init__(self, path):
         self.lock = threading.RLock()
         self.data = {}
         self.path = path
+        self.journal_path = path + '.journal' if path else None
         self.file_exists = False
+        self.journal_damaged = False
         self.modified = False
+        self.shared = set()
+        # shared keys whose items are kept as bytes, and saved as hex
+        self.binary = set()
         self.print_error("wallet path", self.path)
         if self.path:
             self.read(self.path)
+            self.read_journal()
 
     def read(self, path):
         """Read the contents of the wallet file."""
@@ -113,16 +127,114 @@ class WalletStorage(PrintError):
                 self.data[key] = value
         self.file_exists = True
 
+    def snapshot_id(self):
+        """Identify the current wallet file, so that a journal is only
+        replayed on top of the file it was written against."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def read_journal(self):
+        """Replay the changes recorded by JournaledWalletStorage."""
+        try:
+            with open(self.journal_path, "r") as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not self.file_exists or header != {'snapshot': self.snapshot_id()}:
+            self.print_error("ignoring stale journal", self.journal_path)
+            self.journal_damaged = True
+            return
+        n = 0
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a partially written last entry is discarded
+                self.journal_damaged = line != ''
+                break
+            self.apply_journal_entry(entry)
+            n += 1
+        self.print_error("replayed %d journal entries" % n)
+
+    def apply_journal_entry(self, entry):
+        op, key = entry[0], entry[1]
+        if op == 'put':
+            self.data[key] = entry[2]
+        elif op == 'pop':
+            self.data.pop(key, None)
+        elif op == 'set':
+            self.data.setdefault(key, {})[entry[2]] = entry[3]
+        elif op == 'del':
+            self.data.get(key, {}).pop(entry[2], None)
+
     def get(self, key, default=None):
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
+            elif key in self.binary:
+                v = self.encode_items(key, v)
             else:
                 v = copy.deepcopy(v)
         return v
 
+    def borrow(self, key, default=None):
+        """Like get(), but returns the stored value itself instead of
+        a copy.  The caller must not modify it."""
+        with self.lock:
+            v = self.data.get(key)
+        return default if v is None else v
+
+    def share(self, key, default=None, binary=False):
+        """Return the stored value without copying it, for a caller
+        that keeps it as its own state.  The caller modifies it while
+        holding self.lock, and calls put() with it to mark it modified;
+        it is then written as it is, without being copied or checked
+        for json compatibility beforehand.  write() leaves out what
+        cannot be serialized, with an error.
+
+        With binary, the value is a map of hex strings, which are
+        decoded in place: the caller sets bytes, and they are encoded
+        again when saved."""
+        with self.lock:
+            v = self.data.get(key)
+            if v is None:
+                v = self.data[key] = default
+            self.shared.add(key)
+            if binary and key not in self.binary:
+                self.binary.add(key)
+                self.decode_items(v)
+        return v
+
+    def decode_items(self, value):
+        for k, v in value.items():
+            value[k] = v.decode('hex')
+
+    def encode_items(self, key, value):
+        "The value of key as it is saved"
+        if key not in self.binary:
+            return value
+        return dict((k, v.encode('hex')) for k, v in value.items())
+
+    def touch(self, key, item):
+        """Record that item of the shared value key was changed in
+        place.  The change is saved by the next put() of key; this
+        engine rewrites whole values, so nothing needs to be recorded."""
+        pass
+
     def put(self, key, value):
+        if key in self.shared and value is not None:
+            with self.lock:
+                self.data[key] = value
+                self.modified = True
+            return
         try:
             json.dumps(key)
             json.dumps(value)
@@ -130,6 +242,8 @@ class WalletStorage(PrintError):
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
+            self.shared.discard(key)
+            self.binary.discard(key)
             if value is not None:
                 if self.data.get(key) != value:
                     self.modified = True
@@ -139,15 +253,38 @@ class WalletStorage(PrintError):
                 self.data.pop(key)
 
     def write(self):
+        if in_daemon_thread():
+            # the thread may be killed while writing
+            get_save_scheduler().schedule(self.write)
+            return
         with self.lock: self._write()
 
+    def compact(self):
+        """Make the wallet file self-contained, e.g. before copying it."""
+        self.write()
+
+    def dumps(self):
+        """Serialize the data.  Shared values are not checked by put(),
+        so those that cannot be serialized are left out here instead."""
+        data = dict(self.data)
+        for key in self.binary:
+            if key in data:
+                data[key] = self.encode_items(key, data[key])
+        try:
+            return json.dumps(data, indent=4, sort_keys=True)
+        except (TypeError, ValueError):
+            for key in self.shared:
+                try:
+                    json.dumps(data.get(key))
+                except (TypeError, ValueError):
+                    self.print_error("json error: cannot save", key)
+                    data.pop(key, None)
+            return json.dumps(data, indent=4, sort_keys=True)
+
     def _write(self):
-        if threading.currentThread().isDaemon():
-            self.print_error('warning: daemon thread cannot write wallet')
-            return
         if not self.modified:
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
+        s = self.dumps()
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w") as f:
             f.write(s)
@@ -162,10 +299,536 @@ class WalletStorage(PrintError):
             os.remove(self.path)
             os.rename(temp_path, self.path)
         os.chmod(self.path, mode)
+        # the new file contains every journaled change
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
         self.print_error("saved", self.path)
         self.modified = False
 
 
+class JournaledWalletStorage(WalletStorage):
+    """Wallet storage that appends the changes passed to put() to a
+    journal file next to the wallet file, instead of rewriting the
+    whole file on every write.  The wallet file is rewritten (and the
+    journal discarded) once the journal grows larger than the file.
+
+    Other values are journaled whole: only the items of shared values
+    passed to touch() are journaled with their values at write time,
+    so large maps that change item by item should be shared.
+    """
+
+    min_compaction_size = 1 << 20
+
+    def __init__(self, path):
+        self.pending = []
+        # shared key -> items passed to touch(), or None if the whole
+        # value was replaced
+        self.dirty = {}
+        WalletStorage.__init__(self, path)
+
+    def touch(self, key, item):
+        with self.lock:
+            items = self.dirty.setdefault(key, set())
+            if items is not None:
+                items.add(item)
+
+    def put(self, key, value):
+        if key in self.shared and value is not None:
+            # only the items passed to touch() are journaled
+            with self.lock:
+                if value is not self.data.get(key):
+                    self.data[key] = value
+                    self.dirty[key] = None
+                self.modified = True
+            return
+        try:
+            json.dumps(key)
+            json.dumps(value)
+        except:
+            self.print_error("json error: cannot save", key)
+            return
+        with self.lock:
+            self.shared.discard(key)
+            self.binary.discard(key)
+            self.dirty.pop(key, None)
+            if value is not None:
+                if self.data.get(key) != value:
+                    self.modified = True
+                    self.data[key] = copy.deepcopy(value)
+                    self.pending.append(['put', key, self.data[key]])
+            elif key in self.data:
+                self.modified = True
+                self.pending.append(['pop', key])
+                self.data.pop(key)
+
+    def flush_dirty(self):
+        """Turn the changes recorded by touch() into journal entries,
+        with the current values of the changed items.  Entries that
+        cannot be serialized are left out, as put() does not check
+        shared values."""
+        for key, items in self.dirty.items():
+            for entry in self.changed_items(key, items):
+                try:
+                    json.dumps(entry)
+                except (TypeError, ValueError):
+                    self.print_error("json error: cannot save", key)
+                    continue
+                self.pending.append(entry)
+        self.dirty = {}
+
+    def changed_items(self, key, items):
+        value = self.data.get(key)
+        if value is None:
+            return [['pop', key]]
+        if items is None:
+            return [['put', key, self.encode_items(key, value)]]
+        encode = (lambda v: v.encode('hex')) if key in self.binary else (lambda v: v)
+        return [['set', key, k, encode(value[k])] if k in value else ['del', key, k]
+                for k in items]
+
+    def compact(self):
+        with self.lock:
+            self.flush_dirty()
+            self.modified = True
+            WalletStorage._write(self)
+            if not self.modified:
+                self.pending = []
+                self.journal_damaged = False
+
+    def _write(self):
+        if not self.modified:
+            return
+        self.flush_dirty()
+        try:
+            snapshot_size = os.path.getsize(self.path)
+            journal_size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        except OSError:
+            snapshot_size = None
+        if snapshot_size is None or self.journal_damaged or \
+           journal_size > max(snapshot_size, self.min_compaction_size):
+            WalletStorage._write(self)
+        else:
+            self.append_journal()
+        if not self.modified:
+            self.pending = []
+            self.journal_damaged = False
+
+    def append_journal(self):
+        if not os.path.exists(self.journal_path):
+            lines = [json.dumps({'snapshot': self.snapshot_id()})]
+        else:
+            lines = []
+        lines.extend(json.dumps(entry) for entry in self.pending)
+        # the journal holds keys like the wallet file, so it gets the same mode
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     stat.S_IREAD | stat.S_IWRITE)
+        with os.fdopen(fd, "a") as f:
+            f.write(''.join(line + '\n' for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self.print_error("journaled %d changes" % len(self.pending))
+        self.modified = False
+
+
+class SqliteTable(object):
+    """Map of the rows of a table of SqliteWalletStorage.  Only the keys
+    are read when the wallet is opened; values are read from the table
+    when they are used, and values set since the last write are kept
+    until they are saved."""
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.row_keys = set(k for (k,) in db.execute("SELECT key FROM %s" % table))
+        self.values = {}
+        # rows holding hex strings, read as bytes; see WalletStorage.share
+        self.binary = False
+
+    def __len__(self):
+        return len(self.row_keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key in self.row_keys
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        if key not in self.row_keys:
+            raise KeyError(key)
+        row = self.db.execute("SELECT value FROM %s WHERE key=?" % self.table, (key,)).fetchone()
+        value = json.loads(row[0])
+        return value.decode('hex') if self.binary else value
+
+    def __setitem__(self, key, value):
+        self.row_keys.add(key)
+        self.values[key] = value
+
+    def get(self, key, default=None):
+        return self[key] if key in self.row_keys else default
+
+    def pop(self, key, *default):
+        if key not in self.row_keys and default:
+            return default[0]
+        value = self[key]
+        self.row_keys.remove(key)
+        self.values.pop(key, None)
+        return value
+
+    def keys(self):
+        return list(self.row_keys)
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def saved(self):
+        "The changed values were written to the table"
+        self.values.clear()
+
+
+class SqliteWalletStorage(JournaledWalletStorage):
+    """Wallet storage backed by an SQLite database.  The transaction
+    and history maps are stored one row per item, in tables named
+    after their storage key; other keys go to the 'kv' table.  Changes
+    are recorded as in JournaledWalletStorage, and applied to the rows
+    in a single database transaction on write().  The raw transactions
+    are not loaded: the wallet shares an SqliteTable that reads them
+    on demand.
+
+    A JSON wallet file opened with this class is converted, and the
+    original file is kept with a '.json' suffix.
+    """
+
+    tables = ['transactions', 'txi', 'txo', 'pruned_txo', 'tx_fees',
+              'addr_history', 'verified_tx3']
+    lazy_tables = ['transactions']
+
+    def __init__(self, path):
+        self.db = None
+        JournaledWalletStorage.__init__(self, path)
+
+    def read(self, path):
+        if not os.path.exists(path):
+            # the database is created on the first write
+            return
+        if not is_sqlite_file(path):
+            self.migrate(path)
+        self.connect(path)
+        cursor = self.db.cursor()
+        for table in ['kv'] + self.tables:
+            if table in self.lazy_tables:
+                rows = SqliteTable(self.db, table)
+                if rows:
+                    self.data[table] = rows
+                continue
+            for k, v in cursor.execute("SELECT key, value FROM %s" % table):
+                if table == 'kv':
+                    self.data[k] = json.loads(v)
+                else:
+                    self.data.setdefault(table, {})[k] = json.loads(v)
+        self.file_exists = bool(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            v = self.data.get(key)
+            if isinstance(v, SqliteTable):
+                return self.encode_items(key, dict(v.items()))
+        return JournaledWalletStorage.get(self, key, default)
+
+    def decode_items(self, value):
+        if isinstance(value, SqliteTable):
+            value.binary = True
+        else:
+            JournaledWalletStorage.decode_items(self, value)
+
+    def read_journal(self):
+        pass
+
+    def connect(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        with self.db:
+            for table in ['kv'] + self.tables:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s "
+                                "(key TEXT PRIMARY KEY, value TEXT)" % table)
+
+    def migrate(self, path):
+        self.print_error("converting wallet file to sqlite", path)
+        storage = WalletStorage(path)
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        self.connect(temp_path)
+        self.apply_changes([['put', k, v] for k, v in storage.data.items()])
+        self.db.close()
+        os.chmod(temp_path, os.stat(path).st_mode)
+        os.rename(path, path + '.json')
+        if os.path.exists(storage.journal_path):
+            os.rename(storage.journal_path, path + '.json.journal')
+        os.rename(temp_path, path)
+
+    def apply_changes(self, entries):
+        with self.db:
+            for entry in entries:
+                op, key = entry[0], entry[1]
+                if key not in self.tables:
+                    if op == 'put':
+                        self.db.execute("INSERT OR REPLACE INTO kv VALUES (?,?)",
+                                        (key, json.dumps(entry[2])))
+                    else:
+                        self.db.execute("DELETE FROM kv WHERE key=?", (key,))
+                elif op in ['put', 'pop']:
+                    self.db.execute("DELETE FROM %s" % key)
+                    if op == 'put':
+                        self.db.executemany("INSERT INTO %s VALUES (?,?)" % key,
+                                            [(k, json.dumps(v)) for k, v in entry[2].items()])
+                elif op == 'set':
+                    self.db.execute("INSERT OR REPLACE INTO %s VALUES (?,?)" % key,
+                                    (entry[2], json.dumps(entry[3])))
+                elif op == 'del':
+                    self.db.execute("DELETE FROM %s WHERE key=?" % key, (entry[2],))
+
+    def changed_items(self, key, items):
+        if key not in self.tables:
+            items = None
+        return JournaledWalletStorage.changed_items(self, key, items)
+
+    def compact(self):
+        self.write()
+
+    def _write(self):
+        if not self.modified:
+            return
+        if self.db is None:
+            self.connect(self.path)
+            os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+        self.flush_dirty()
+        self.apply_changes(self.pending)
+        self.pending = []
+        for v in self.data.values():
+            if isinstance(v, SqliteTable):
+                v.saved()
+        self.modified = False
+        self.file_exists = True
+        self.print_error("saved", self.path)
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == 'SQLite format 3\x00'
+    except IOError:
+        return False
+
+
+WALLET_STORAGES = {
+    'json': WalletStorage,
+    'journal': JournaledWalletStorage,
+    'sqlite': SqliteWalletStorage,
+}
+
+def get_storage_class(config):
+    kind = config.get('wallet_storage')
+    return WALLET_STORAGES.get(kind, WalletStorage)
+
+
+class TransactionStore(PrintError):
+    """Map of tx_hash to Transaction, backed by the serialized
+    transactions of the wallet file. Transactions are deserialized on
+    demand, and only the most recently used ones are kept."""
+
+    max_cached = 1000
+
+    def __init__(self, raw, lock):
+        self.raw = raw      # tx_hash -> bytes, shared with the storage
+        self.lock = lock
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        return iter(self.raw.keys())
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw
+
+    def __getitem__(self, tx_hash):
+        tx = self.get(tx_hash)
+        if tx is None:
+            raise KeyError(tx_hash)
+        return tx
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.raw[tx_hash] = str(tx).decode('hex')
+            self.cache.pop(tx_hash, None)
+            self.cache[tx_hash] = tx
+            self.trim()
+
+    def get(self, tx_hash, default=None):
+        with self.lock:
+            tx = self.cache.pop(tx_hash, None)
+            if tx is None:
+                raw = self.raw.get(tx_hash)
+                if raw is None:
+                    return default
+                tx = Transaction(raw.encode('hex'))
+            self.cache[tx_hash] = tx
+            self.trim()
+            return tx
+
+    def pop(self, tx_hash, *default):
+        with self.lock:
+            tx = self.cache.pop(tx_hash, None)
+            if tx_hash not in self.raw and default:
+                return default[0]
+            raw = self.raw.pop(tx_hash)
+            return tx if tx is not None else Transaction(raw.encode('hex'))
+
+    def discard(self, tx_hash):
+        """Remove a transaction, without parsing it"""
+        with self.lock:
+            self.cache.pop(tx_hash, None)
+            self.raw.pop(tx_hash, None)
+
+    def trim(self):
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    def keys(self):
+        return self.raw.keys()
+
+    def items(self):
+        return [(tx_hash, self[tx_hash]) for tx_hash in self.raw.keys()]
+
+
+class HistoryIndex(object):
+    """Transactions of the wallet, sorted by position in the blockchain,
+    with their delta for each address and the running sum of their
+    deltas. Transactions marked dirty, or touching addresses that were
+    added to or removed from the domain, are moved or recomputed on the
+    next update, and only the sums that follow them are recomputed."""
+
+    def __init__(self):
+        self.domain = set()
+        self.keys = []      # sorted (txpos, tx_hash)
+        self.txpos = {}
+        self.deltas = {}
+        self.addr_deltas = {}
+        # (sum of known deltas, number of unknown deltas) up to keys[i]
+        self.sums = []
+        # marked from any thread, while the caller may hold wallet locks
+        self.dirty = set()
+        self.dirty_lock = threading.Lock()
+
+    def invalidate(self, tx_hashes):
+        with self.dirty_lock:
+            self.dirty.update(tx_hashes)
+
+    def update(self, wallet, domain=None):
+        "Apply the changes to the transactions, and to domain if given"
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, set()
+        domain = self.domain if domain is None else set(domain)
+        added, removed = domain - self.domain, self.domain - domain
+        for addr in added:
+            for tx_hash, height in wallet.get_address_history(addr):
+                dirty.add(tx_hash)
+        if removed:
+            for tx_hash, addr_deltas in self.addr_deltas.items():
+                if not removed.isdisjoint(addr_deltas):
+                    dirty.add(tx_hash)
+        self.domain = domain
+        start = len(self.keys)
+        for tx_hash in dirty:
+            txpos = self.txpos.pop(tx_hash, None)
+            if txpos is not None:
+                i = bisect_left(self.keys, (txpos, tx_hash))
+                del self.keys[i]
+                self.deltas.pop(tx_hash)
+                self.addr_deltas.pop(tx_hash)
+                start = min(start, i)
+            addrs = wallet.tx_addr_hist.get(tx_hash, set()) & self.domain
+            if not addrs:
+                continue
+            addr_deltas = dict((addr, wallet.get_tx_delta(tx_hash, addr))
+                               for addr in addrs)
+            txpos = wallet.get_txpos(tx_hash)
+            i = bisect_left(self.keys, (txpos, tx_hash))
+            self.keys.insert(i, (txpos, tx_hash))
+            self.txpos[tx_hash] = txpos
+            self.deltas[tx_hash] = self.sum_deltas(addr_deltas.values())
+            self.addr_deltas[tx_hash] = addr_deltas
+            start = min(start, i)
+        self.update_sums(start)
+
+    @staticmethod
+    def sum_deltas(deltas):
+        return None if None in deltas else sum(deltas)
+
+    def update_sums(self, start):
+        del self.sums[start:]
+        total, unknown = self.sums[-1] if self.sums else (0, 0)
+        for txpos, tx_hash in self.keys[start:]:
+            delta = self.deltas[tx_hash]
+            if delta is None:
+                unknown += 1
+            else:
+                total += delta
+            self.sums.append((total, unknown))
+
+    def filter(self, domain):
+        """Return the index of the transactions that touch the addresses
+        of domain, with their deltas restricted to these addresses"""
+        domain = set(domain)
+        if domain >= self.domain:
+            return self
+        index = HistoryIndex()
+        index.domain = domain & self.domain
+        for key in self.keys:
+            tx_hash = key[1]
+            addr_deltas = self.addr_deltas[tx_hash]
+            deltas = [d for addr, d in addr_deltas.items() if addr in domain]
+            if deltas:
+                index.keys.append(key)
+                index.deltas[tx_hash] = self.sum_deltas(deltas)
+        index.update_sums(0)
+        return index
+
+    def get_range(self, from_height=None, to_height=None):
+        lo = 0 if from_height is None else bisect_left(self.keys, ((from_height,),))
+        hi = len(self.keys) if to_height is None else bisect_left(self.keys, ((to_height + 1,),))
+        return lo, max(lo, hi)
+
+
+class KeyContext(object):
+    '''Secrets unlocked by a password for the duration of one operation,
+    such as signing a transaction.  Each secret is derived once, the
+    first time it is needed, and the context forgets all of them on
+    exit.'''
+
+    def __init__(self, password):
+        self.password = password
+        self.secrets = {}
+
+    def get(self, name, derive):
+        "Returns the secret called name, computing it with derive(password)"
+        if name not in self.secrets:
+            self.secrets[name] = derive(self.password)
+        return self.secrets[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.secrets.clear()
+        self.password = None
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -183,6 +846,9 @@ class Abstract_Wallet(PrintError):
         self.verifier = None
 
         self.gap_limit_for_change = 6 # constant
+        # large maps are shared with the storage, and changed items are
+        # passed to storage.touch() with the transaction lock held
+        share = getattr(storage, 'share', storage.get)
         # saved fields
         self.seed_version          = storage.get('seed_version', NEW_SEED_VERSION)
         self.use_change            = storage.get('use_change', True)
@@ -192,11 +858,14 @@ class Abstract_Wallet(PrintError):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = share('addr_history', {})             # address -> list(txid, height)
 
         # imported_keys is deprecated. The GUI should call convert_imported_keys
         self.imported_keys = self.storage.get('imported_keys',{})
 
+        # txi, txo, pruned_txo and tx_fees are shared with the storage
+        self.transaction_lock = getattr(storage, 'lock', None) or threading.RLock()
+
         self.load_accounts()
         self.load_transactions()
         self.build_reverse_history()
@@ -208,15 +877,31 @@ class Abstract_Wallet(PrintError):
         # height.  Access is not contended so no lock is needed.
         self.unverified_tx = defaultdict(int)
 
-        # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx   = storage.get('verified_tx3',{})
+        # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock,
+        # and change with the transaction lock held as well.
+        self.verified_tx   = share('verified_tx3', {})
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
         self.lock = threading.Lock()
-        self.transaction_lock = threading.Lock()
+        # transactions of all the accounts, see get_history
+        self.history_index = HistoryIndex()
+        # set when addresses are added or removed, see save_accounts
+        self.history_domain_changed = True
+        self.history_lock = threading.Lock()
+        # Private keys kept decrypted between signing operations, for
+        # unlock_ttl seconds after they are first used (0 disables it).
+        # A timer forgets them then, even if no key is used again.
+        # While they are kept, the password is checked against
+        # unlock_verifier, a salted hash of it, instead of decrypting
+        # the master key.  Access with self.lock.
+        self.unlock_ttl = 0
+        self.unlocked_keys = {}
+        self.unlocked_until = 0
+        self.unlock_timer = None
+        self.unlock_verifier = None
 
         self.check_history()
 
@@ -239,26 +924,33 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.tx_fees = self.storage.get('tx_fees', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        share = getattr(self.storage, 'share', self.storage.get)
+        self.txi = share('txi', {})
+        self.txo = share('txo', {})
+        self.tx_fees = share('tx_fees', {})
+        self.pruned_txo = share('pruned_txo', {})
+        self.build_spend_index()
+        if hasattr(self.storage, 'share'):
+            tx_list = self.storage.share('transactions', {}, binary=True)
+        else:
+            tx_list = dict((k, v.decode('hex')) for k, v in self.storage.get('transactions', {}).items())
+        self.transactions = TransactionStore(tx_list, self.transaction_lock)
+        for tx_hash in tx_list.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_by_tx):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.transactions.discard(tx_hash)
+                self.storage.touch('transactions', tx_hash)
+        # address -> (received, sent, utxo), see get_addr_io.  The entries
+        # of an address are dropped when its transactions change, and
+        # recomputed from its history when next used.
+        self.addr_io_cache = {}
+        # address -> (c, u, x, local height if it received coinbase outputs)
+        self.addr_balance_cache = {}
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
+            self.storage.put('transactions', self.transactions.raw)
             self.storage.put('txi', self.txi)
             self.storage.put('txo', self.txo)
             self.storage.put('tx_fees', self.tx_fees)
@@ -273,10 +965,36 @@ class Abstract_Wallet(PrintError):
             self.txo = {}
             self.tx_fees = {}
             self.pruned_txo = {}
+            self.spent_by = {}
+            self.pruned_by_tx = {}
+            self.addr_io_cache = {}
+            self.addr_balance_cache = {}
         self.save_transactions()
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.history_index = HistoryIndex()
+        self.history_domain_changed = True
+
+    def build_spend_index(self):
+        # prevout tx_hash -> hashes of the txs whose txi spend it
+        self.spent_by = {}
+        # tx_hash -> its inputs that are in pruned_txo
+        self.pruned_by_tx = {}
+        for next_tx, dd in self.txi.items():
+            for addr, l in dd.items():
+                for ser, v in l:
+                    self.spent_by.setdefault(ser.split(':')[0], set()).add(next_tx)
+        for ser, tx_hash in self.pruned_txo.items():
+            self.pruned_by_tx.setdefault(tx_hash, set()).add(ser)
+
+    def discard_from_index(self, index, key, value):
+        "Remove value from the set index[key], and the key once it is empty"
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
 
     @profiler
     def build_reverse_history(self):
@@ -292,16 +1010,18 @@ class Abstract_Wallet(PrintError):
         save = False
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
-                self.history.pop(addr)
+                with self.transaction_lock:
+                    self.history.pop(addr)
+                    self.storage.touch('addr_history', addr)
+                self.invalidate_addresses([addr])
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_by_tx or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
-                tx = self.transactions.get(tx_hash)
-                if tx is not None:
-                    self.add_transaction(tx_hash, tx)
+                if tx_hash in self.transactions:
+                    self.add_transaction(tx_hash, self.transactions[tx_hash])
                     save = True
         if save:
             self.save_transactions()
@@ -362,7 +1082,8 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.up_to_date = up_to_date
         if up_to_date:
-            self.save_transactions(write=True)
+            self.save_transactions()
+            get_save_scheduler().schedule(self.storage.write)
 
     def is_up_to_date(self):
         with self.lock: return self.up_to_date
@@ -370,7 +1091,7 @@ class Abstract_Wallet(PrintError):
     def is_imported(self, addr):
         account = self.accounts.get(IMPORTED_ACCOUNT)
         if account:
-            return addr in account.get_addresses(0)
+            return account.get_address_index(addr) is not None
         else:
             return False
 
@@ -397,7 +1118,10 @@ class Abstract_Wallet(PrintError):
 
         # force resynchronization, because we need to re-run add_transaction
         if address in self.history:
-            self.history.pop(address)
+            with self.transaction_lock:
+                self.history.pop(address)
+                self.storage.touch('addr_history', address)
+            self.invalidate_addresses([address])
 
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -432,7 +1156,8 @@ class Abstract_Wallet(PrintError):
         return list(addr for acc in self.accounts for addr in self.get_account_addresses(acc, include_change))
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return any(account.get_address_index(address) is not None
+                   for account in self.accounts.values())
 
     def is_change(self, address):
         if not self.is_mine(address): return False
@@ -441,11 +1166,10 @@ class Abstract_Wallet(PrintError):
         return s[0] == 1
 
     def get_address_index(self, address):
-        for acc_id in self.accounts:
-            for for_change in [0,1]:
-                addresses = self.accounts[acc_id].get_addresses(for_change)
-                if address in addresses:
-                    return acc_id, (for_change, addresses.index(address))
+        for acc_id, account in self.accounts.items():
+            sequence = account.get_address_index(address)
+            if sequence is not None:
+                return acc_id, sequence
         raise Exception("Address not found", address)
 
     def get_private_key(self, address, password):
@@ -477,13 +1201,17 @@ class Abstract_Wallet(PrintError):
     def add_unverified_tx(self, tx_hash, tx_height):
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
+            if self.unverified_tx.get(tx_hash) != tx_height:
+                self.invalidate_history([tx_hash])
             self.unverified_tx[tx_hash] = tx_height
 
     def add_verified_tx(self, tx_hash, info):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
-        with self.lock:
+        with self.lock, self.transaction_lock:
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self.storage.touch('verified_tx3', tx_hash)
+        self.invalidate_history([tx_hash])
         self.storage.put('verified_tx3', self.verified_tx)
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
@@ -495,12 +1223,17 @@ class Abstract_Wallet(PrintError):
     def undo_verifications(self, height):
         '''Used by the verifier when a reorg has happened'''
         txs = []
-        with self.lock:
-            for tx_hash, item in self.verified_tx:
+        with self.lock, self.transaction_lock:
+            for tx_hash, item in self.verified_tx.items():
                 tx_height, timestamp, pos = item
                 if tx_height >= height:
-                    self.verified_tx.pop(tx_hash, None)
+                    self.verified_tx.pop(tx_hash)
+                    self.storage.touch('verified_tx3', tx_hash)
+                    self.unverified_tx[tx_hash] = tx_height
                     txs.append(tx_hash)
+        if txs:
+            self.invalidate_history(txs)
+            self.storage.put('verified_tx3', self.verified_tx)
         return txs
 
     def get_local_height(self):
@@ -541,7 +1274,7 @@ class Abstract_Wallet(PrintError):
     def get_tx_delta(self, tx_hash, address):
         "effect of tx on address"
         # pruned
-        if tx_hash in self.pruned_txo.values():
+        if self.pruned_by_tx.get(tx_hash):
             return None
         delta = 0
         # substract the value of coins sent from address
@@ -556,7 +1289,6 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.addresses(True)
         is_relevant = False
         is_mine = False
         is_pruned = False
@@ -564,7 +1296,7 @@ class Abstract_Wallet(PrintError):
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
             addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
                 d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
@@ -584,7 +1316,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -616,7 +1348,7 @@ class Abstract_Wallet(PrintError):
         height = conf = timestamp = None
         if tx.is_complete():
             tx_hash = tx.hash()
-            if tx_hash in self.transactions.keys():
+            if tx_hash in self.transactions:
                 label = self.get_label(tx_hash)
                 height, conf, timestamp = self.get_tx_height(tx_hash)
                 if height > 0:
@@ -655,24 +1387,36 @@ class Abstract_Wallet(PrintError):
         return tx_hash, status, label, can_broadcast, can_bump, amount, fee, height, conf, timestamp, exp_n
 
 
+    def invalidate_addresses(self, addresses):
+        "Forget the cached coins and balances of addresses"
+        with self.transaction_lock:
+            for addr in addresses:
+                self.addr_io_cache.pop(addr, None)
+                self.addr_balance_cache.pop(addr, None)
+
     def get_addr_io(self, address):
-        h = self.history.get(address, [])
-        received = {}
-        sent = {}
-        for tx_hash, height in h:
-            l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
-        for tx_hash, height in h:
-            l = self.txi.get(tx_hash, {}).get(address, [])
-            for txi, v in l:
-                sent[txi] = height
-        return received, sent
+        """Returns the (received, sent, utxo) dicts of address.  They
+        are cached, so callers must not modify them."""
+        with self.transaction_lock:
+            io = self.addr_io_cache.get(address)
+            if io is None:
+                h = self.history.get(address, [])
+                received = {}
+                sent = {}
+                for tx_hash, height in h:
+                    l = self.txo.get(tx_hash, {}).get(address, [])
+                    for n, v, is_cb in l:
+                        received[tx_hash + ':%d'%n] = (height, v, is_cb)
+                for tx_hash, height in h:
+                    l = self.txi.get(tx_hash, {}).get(address, [])
+                    for txi, v in l:
+                        sent[txi] = height
+                utxo = dict((k, v) for k, v in received.items() if k not in sent)
+                io = self.addr_io_cache[address] = received, sent, utxo
+        return io
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        received, sent, coins = self.get_addr_io(address)
         out = []
         for txo, v in coins.items():
             tx_height, value, is_cb = v
@@ -690,26 +1434,35 @@ class Abstract_Wallet(PrintError):
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
+        received, sent, utxo = self.get_addr_io(address)
         return sum([v for height, v, is_cb in received.values()])
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+        local_height = self.get_local_height()
+        with self.transaction_lock:
+            b = self.addr_balance_cache.get(address)
+            # coinbase outputs mature as the local height changes
+            if b is None or b[3] not in [None, local_height]:
+                received, sent, utxo = self.get_addr_io(address)
+                c = u = x = 0
+                cb_height = None
+                for txo, (tx_height, v, is_cb) in received.items():
+                    if is_cb:
+                        cb_height = local_height
+                    if is_cb and tx_height + COINBASE_MATURITY > local_height:
+                        x += v
+                    elif tx_height > 0:
+                        c += v
+                    else:
+                        u += v
+                    if txo in sent:
+                        if sent[txo] > 0:
+                            c -= v
+                        else:
+                            u -= v
+                b = self.addr_balance_cache[address] = c, u, x, cb_height
+        return b[0:3]
 
 
     def get_spendable_coins(self, domain = None, exclude_frozen = True):
@@ -721,7 +1474,7 @@ class Abstract_Wallet(PrintError):
         for addr in domain:
             utxos = self.get_addr_utxo(addr)
             for x in utxos:
-                if x['coinbase'] and x['tx_height'] + COINBASE_MATURITY > self.get_local_height():
+                if x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
                     continue
                 coins.append(x)
                 continue
@@ -756,8 +1509,8 @@ class Abstract_Wallet(PrintError):
 
     def get_account_from_address(self, addr):
         "Returns the account that contains this address, or None"
-        for acc_id in self.accounts:    # similar to get_address_index but simpler
-            if addr in self.get_account_addresses(acc_id):
+        for acc_id, account in self.accounts.items():
+            if account.get_address_index(addr) is not None:
                 return acc_id
         return None
 
@@ -795,6 +1548,7 @@ class Abstract_Wallet(PrintError):
         with self.transaction_lock:
             # add inputs
             self.txi[tx_hash] = d = {}
+            self.storage.touch('txi', tx_hash)
             for txi in tx.inputs():
                 addr = txi.get('address')
                 if not txi.get('is_coinbase'):
@@ -811,12 +1565,16 @@ class Abstract_Wallet(PrintError):
                             if d.get(addr) is None:
                                 d[addr] = []
                             d[addr].append((ser, v))
+                            self.spent_by.setdefault(prevout_hash, set()).add(tx_hash)
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
+                        self.pruned_by_tx.setdefault(tx_hash, set()).add(ser)
+                        self.storage.touch('pruned_txo', ser)
 
             # add outputs
             self.txo[tx_hash] = d = {}
+            self.storage.touch('txo', tx_hash)
             for n, txo in enumerate(tx.outputs()):
                 ser = tx_hash + ':%d'%n
                 _type, x, v = txo
@@ -834,22 +1592,36 @@ class Abstract_Wallet(PrintError):
                 next_tx = self.pruned_txo.get(ser)
                 if next_tx is not None:
                     self.pruned_txo.pop(ser)
+                    self.discard_from_index(self.pruned_by_tx, next_tx, ser)
+                    self.spent_by.setdefault(tx_hash, set()).add(next_tx)
                     dd = self.txi.get(next_tx, {})
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.storage.touch('pruned_txo', ser)
+                    self.storage.touch('txi', next_tx)
+                    self.invalidate_addresses([addr])
+                    self.invalidate_history([next_tx])
             # save
             self.transactions[tx_hash] = tx
+            self.storage.touch('transactions', tx_hash)
+            self.invalidate_addresses(self.txi[tx_hash].keys() + d.keys())
+            self.invalidate_history([tx_hash])
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
+            for ser in self.pruned_by_tx.pop(tx_hash, []):
+                if self.pruned_txo.get(ser) == tx_hash:
                     self.pruned_txo.pop(ser)
+                    self.storage.touch('pruned_txo', ser)
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self.discard_from_index(self.spent_by, ser.split(':')[0], tx_hash)
             # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
+            for next_tx in self.spent_by.pop(tx_hash, []):
+                dd = self.txi.get(next_tx, {})
                 for addr, l in dd.items():
                     ll = l[:]
                     for item in ll:
@@ -858,15 +1630,23 @@ class Abstract_Wallet(PrintError):
                         if prev_hash == tx_hash:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            self.pruned_by_tx.setdefault(next_tx, set()).add(ser)
+                            self.storage.touch('pruned_txo', ser)
+                            self.storage.touch('txi', next_tx)
+                            self.invalidate_history([next_tx])
+                            self.invalidate_addresses([addr])
                     if l == []:
                         dd.pop(addr)
                     else:
                         dd[addr] = l
+            self.storage.touch('txi', tx_hash)
+            self.storage.touch('txo', tx_hash)
             try:
-                self.txi.pop(tx_hash)
-                self.txo.pop(tx_hash)
+                self.invalidate_addresses(self.txi.pop(tx_hash).keys())
+                self.invalidate_addresses(self.txo.pop(tx_hash).keys())
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self.invalidate_history([tx_hash])
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_transaction(tx_hash, tx)
@@ -874,6 +1654,10 @@ class Abstract_Wallet(PrintError):
         self.add_unverified_tx(tx_hash, tx_height)
 
     def receive_history_callback(self, addr, hist, tx_fees):
+        if not self.is_mine(addr):
+            # still subscribed after being trimmed by finish_restore
+            self.print_error("ignoring history of unknown address", addr)
+            return
         with self.lock:
             old_hist = self.history.get(addr, [])
             for tx_hash, height in old_hist:
@@ -882,7 +1666,10 @@ class Abstract_Wallet(PrintError):
                     self.tx_addr_hist[tx_hash].remove(addr)
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash)
-            self.history[addr] = hist
+            with self.transaction_lock:
+                self.history[addr] = hist
+                self.storage.touch('addr_history', addr)
+            self.invalidate_addresses([addr])
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -892,58 +1679,57 @@ class Abstract_Wallet(PrintError):
             s.add(addr)
             self.tx_addr_hist[tx_hash] = s
             # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
-            if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
-                self.add_transaction(tx_hash, tx)
+            if tx_hash in self.transactions and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
+                self.add_transaction(tx_hash, self.transactions[tx_hash])
+        self.invalidate_history([tx_hash for tx_hash, height in old_hist + hist])
 
+        # Store fees
+        with self.transaction_lock:
+            self.tx_fees.update(tx_fees)
+            for tx_hash in tx_fees:
+                self.storage.touch('tx_fees', tx_hash)
         # Write updated TXI, TXO etc.
         self.save_transactions()
-        # Store fees
-        self.tx_fees.update(tx_fees)
-
-    def get_history(self, domain=None):
-        # get domain
-        if domain is None:
-            domain = self.get_account_addresses(None)
-
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
-
-        # 2. create sorted history
-        history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            height, conf, timestamp = self.get_tx_height(tx_hash)
-            history.append((tx_hash, height, conf, timestamp, delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]))
-        history.reverse()
-
-        # 3. add balance
-        c, u, x = self.get_balance(domain)
-        balance = c + u + x
-        h2 = []
-        for tx_hash, height, conf, timestamp, delta in history:
-            h2.append((tx_hash, height, conf, timestamp, delta, balance))
-            if balance is None or delta is None:
-                balance = None
-            else:
-                balance -= delta
-        h2.reverse()
 
+    def invalidate_history(self, tx_hashes):
+        "Mark transactions whose position, delta or addresses have changed"
+        self.history_index.invalidate(tx_hashes)
+
+    def get_history(self, domain=None, from_height=None, to_height=None, offset=0, count=None):
+        """Return (tx_hash, height, conf, timestamp, delta, balance) for the
+        transactions of domain, oldest first. The history can be limited to
+        a range of block heights, and paginated with offset and count,
+        where offset is the number of most recent items to skip."""
+        with self.history_lock:
+            domain_changed, self.history_domain_changed = self.history_domain_changed, False
+            self.history_index.update(self, self.addresses(True) if domain_changed else None)
+            # the accounts that are not shown have no transactions
+            index = self.history_index if domain is None else self.history_index.filter(domain)
+            total, unknown = index.sums[-1] if index.sums else (0, 0)
+            lo, hi = index.get_range(from_height, to_height)
+            hi = max(lo, hi - offset)
+            if count is not None:
+                lo = max(lo, hi - count)
+            items = [(tx_hash, index.deltas[tx_hash], index.sums[i])
+                     for i, (txpos, tx_hash) in enumerate(index.keys[lo:hi], lo)]
+
+        if domain is None and unknown == 0:
+            # the running sums of the wallet index give its balance
+            balance = total
+        else:
+            c, u, x = self.get_balance(domain)
+            balance = c + u + x
         # fixme: this may happen if history is incomplete
-        if balance not in [None, 0]:
+        if unknown == 0 and balance != total:
             self.print_error("Error: history not synchronized")
             return []
 
+        h2 = []
+        for tx_hash, delta, (s, n) in items:
+            height, conf, timestamp = self.get_tx_height(tx_hash)
+            # balance after tx, known if all later deltas are known
+            b = balance - (total - s) if n == unknown else None
+            h2.append((tx_hash, height, conf, timestamp, delta, b))
         return h2
 
     def get_label(self, tx_hash):
@@ -1092,29 +1878,29 @@ class Abstract_Wallet(PrintError):
             txin['redeemPubkey'] = account.get_pubkey(*sequence)
             txin['num_sig'] = 1
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, processes=None):
         if self.is_watching_only():
             return
-        # Raise if password is not correct.
-        self.check_password(password)
         # Add derivation for utxo in wallets
         for i, addr in self.utxo_can_sign(tx):
             txin = tx.inputs()[i]
             txin['address'] = addr
             self.add_input_info(txin)
-        # Add private keys
+        # Add private keys. Raise if password is not correct.
         keypairs = {}
-        for x in self.xkeys_can_sign(tx):
-            sec = self.get_private_key_from_xpubkey(x, password)
-            if sec:
-                keypairs[x] = sec
+        with self.unlock(password) as context:
+            for x in self.xkeys_can_sign(tx):
+                sec = self.get_private_key_from_xpubkey(x, password, context)
+                if sec:
+                    keypairs[x] = sec
         # Sign
         if keypairs:
-            tx.sign(keypairs)
+            tx.sign(keypairs, processes=processes)
 
     def update_password(self, old_password, new_password):
         if old_password is not None:
             self.check_password(old_password)
+        self.lock_keys()
 
         if new_password == '':
             new_password = None
@@ -1165,7 +1951,8 @@ class Abstract_Wallet(PrintError):
         for tx_hash in self.transactions.keys():
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
-                self.transactions.pop(tx_hash)
+                self.transactions.discard(tx_hash)
+                self.storage.touch('transactions', tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -1179,7 +1966,9 @@ class Abstract_Wallet(PrintError):
             self.synchronizer = None
 
     def stop_threads(self):
+        self.lock_keys()
         if self.network:
+            self.network.unregister_callback(self.verifier.on_reorg)
             self.network.remove_jobs([self.synchronizer, self.verifier])
             self.synchronizer.release()
             self.synchronizer = None
@@ -1233,6 +2022,8 @@ class Abstract_Wallet(PrintError):
         self.save_accounts()
 
     def save_accounts(self):
+        # addresses are only added or removed before saving the accounts
+        self.history_domain_changed = True
         d = {}
         for k, v in self.accounts.items():
             d[k] = v.dump()
@@ -1310,7 +2101,62 @@ class Abstract_Wallet(PrintError):
                 out.add(x)
         return out
 
-    def get_private_key_from_xpubkey(self, x_pubkey, password):
+    def unlock(self, password):
+        "Check the password, and return a KeyContext for it"
+        if not self.check_unlocked_password(password):
+            self.check_password(password)
+        return KeyContext(password)
+
+    def password_verifier(self, password, salt):
+        return hmac.new(salt, Hash(password), hashlib.sha256).digest()
+
+    def check_unlocked_password(self, password):
+        "True if keys are kept unlocked, with that password"
+        self.expire_unlocked_keys()
+        with self.lock:
+            if password is None or self.unlock_verifier is None:
+                return False
+            salt, verifier = self.unlock_verifier
+            return hmac.compare_digest(verifier, self.password_verifier(password, salt))
+
+    def get_unlocked_key(self, name):
+        self.expire_unlocked_keys()
+        with self.lock:
+            return self.unlocked_keys.get(name)
+
+    def keep_unlocked_key(self, name, secret, password):
+        "Keep secret unlocked; password must have been checked"
+        with self.lock:
+            if not self.unlocked_keys:
+                self.unlocked_until = time.time() + self.unlock_ttl
+                self.unlock_timer = threading.Timer(self.unlock_ttl, self.expire_unlocked_keys)
+                self.unlock_timer.daemon = True
+                self.unlock_timer.start()
+                if password is not None:
+                    salt = os.urandom(16)
+                    self.unlock_verifier = salt, self.password_verifier(password, salt)
+            self.unlocked_keys[name] = secret
+
+    def expire_unlocked_keys(self):
+        "Forget the private keys kept unlocked once their time is over"
+        with self.lock:
+            if self.unlocked_keys and time.time() >= self.unlocked_until:
+                self._lock_keys()
+
+    def lock_keys(self):
+        "Forget the private keys kept unlocked"
+        with self.lock:
+            self._lock_keys()
+
+    def _lock_keys(self):
+        if self.unlock_timer:
+            self.unlock_timer.cancel()
+            self.unlock_timer = None
+        self.unlocked_keys.clear()
+        self.unlocked_until = 0
+        self.unlock_verifier = None
+
+    def get_private_key_from_xpubkey(self, x_pubkey, password, context=None):
         if x_pubkey[0:2] in ['02','03','04']:
             addr = bitcoin.public_key_to_bc_address(x_pubkey.decode('hex'))
             if self.is_mine(addr):
@@ -1319,15 +2165,19 @@ class Abstract_Wallet(PrintError):
             xpub, sequence = BIP32_Account.parse_xpubkey(x_pubkey)
             for k, v in self.master_public_keys.items():
                 if v == xpub:
-                    xprv = self.get_master_private_key(k, password)
-                    if xprv:
-                        _, _, _, c, k = deserialize_xkey(xprv)
-                        return bip32_private_key(sequence, k, c)
+                    for_change, n = sequence
+                    branch = self.get_branch_private_key(k, for_change, password, context)
+                    if branch:
+                        return bip32_private_key([n], *branch)
         elif x_pubkey[0:2] == 'fe':
             xpub, sequence = OldAccount.parse_xpubkey(x_pubkey)
             for k, account in self.accounts.items():
                 if xpub in account.get_master_pubkeys():
-                    pk = account.get_private_key(sequence, self, password)
+                    secexp = None
+                    if context:
+                        derive = lambda pw: account.get_master_secret(self, pw)
+                        secexp = context.get(k, derive)
+                    pk = account.get_private_key(sequence, self, password, secexp)
                     return pk[0]
         elif x_pubkey[0:2] == 'fd':
             addrtype = ord(x_pubkey[2:4].decode('hex'))
@@ -1528,6 +2378,10 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, storage):
         Abstract_Wallet.__init__(self, storage)
+        # number of addresses derived ahead while restoring, 0 otherwise
+        self.restore_window = storage.get('restore_window', 0)
+        # multiprocessing pool deriving the windows, see start_restore
+        self.restore_pool = None
 
     def has_seed(self):
         return self.seed != ''
@@ -1569,6 +2423,7 @@ class Deterministic_Wallet(Abstract_Wallet):
                 n = len(addresses) - k + value
                 account.receiving_pubkeys = account.receiving_pubkeys[0:n]
                 account.receiving_addresses = account.receiving_addresses[0:n]
+                account.index_addresses()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_accounts()
@@ -1610,10 +2465,16 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        self.add_addresses([address])
+
+    def add_addresses(self, addresses):
+        with self.transaction_lock:
+            for address in addresses:
+                if address not in self.history:
+                    self.history[address] = []
+                    self.storage.touch('addr_history', address)
         if self.synchronizer:
-            self.synchronizer.add(address)
+            self.synchronizer.add_addresses(addresses)
         self.save_accounts()
 
     def synchronize(self):
@@ -1621,11 +2482,61 @@ class Deterministic_Wallet(Abstract_Wallet):
             for account in self.accounts.values():
                 account.synchronize(self)
 
+    def start_restore(self, window=1000, pool=None):
+        '''Until the synchronizer is up to date, derive addresses in
+        windows of window addresses, instead of gap_limit.  The windows
+        are derived with pool, a multiprocessing pool, if the caller
+        created one before starting any thread; only the command line
+        restore does, the install wizard derives them in process.'''
+        self.restore_window = window
+        self.restore_pool = pool
+        self.storage.put('restore_window', window)
+
+    def finish_restore(self):
+        '''Trim the unused addresses derived ahead by the restore window
+        down to the gap limits.  Returns False if a window is still
+        being extended.'''
+        removed = []
+        with self.lock:
+            for account in self.accounts.values():
+                if type(account) == ImportedAccount:
+                    continue
+                for for_change in [0, 1]:
+                    addresses = account.get_addresses(for_change)
+                    k = self.num_unused_trailing_addresses(addresses)
+                    if k < min(self.restore_window, len(addresses)):
+                        return False
+            for account in self.accounts.values():
+                if type(account) == ImportedAccount:
+                    continue
+                for for_change in [0, 1]:
+                    addresses = account.get_addresses(for_change)
+                    k = self.num_unused_trailing_addresses(addresses)
+                    limit = self.gap_limit_for_change if for_change else self.gap_limit
+                    if k > limit:
+                        removed += account.remove_addresses(for_change, k - limit)
+            with self.transaction_lock:
+                for address in removed:
+                    self.history.pop(address, None)
+                    self.storage.touch('addr_history', address)
+            self.restore_window = 0
+            self.restore_pool = None
+        self.invalidate_addresses(removed)
+        self.storage.put('restore_window', 0)
+        self.save_accounts()
+        self.print_error("restore done, removed %d unused addresses" % len(removed))
+        return True
+
+    def set_up_to_date(self, up_to_date):
+        if up_to_date and self.restore_window:
+            up_to_date = self.finish_restore()
+        Abstract_Wallet.set_up_to_date(self, up_to_date)
+
     def is_beyond_limit(self, address, account, is_change):
         if type(account) == ImportedAccount:
             return False
         addr_list = account.get_addresses(is_change)
-        i = addr_list.index(address)
+        i = account.get_address_index(address)[1]
         prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
         if len(prev_addresses) < limit:
@@ -1685,6 +2596,26 @@ class BIP32_Wallet(Deterministic_Wallet):
             raise InvalidPassword()
         return xprv
 
+    def get_branch_private_key(self, root, for_change, password, context=None):
+        '''Returns (k, c) of the branch for_change of the master private
+        key root, or None if we do not have that key.  With unlock_ttl
+        set, branch keys stay unlocked across contexts, which are only
+        created once the password has been checked.'''
+        name = (root, for_change)
+        branch = self.get_unlocked_key(name) if context else None
+        if branch is None:
+            derive = lambda pw: self.derive_branch_private_key(root, for_change, pw)
+            branch = context.get(name, derive) if context else derive(password)
+            if branch and context and self.unlock_ttl:
+                self.keep_unlocked_key(name, branch, context.password)
+        return branch
+
+    def derive_branch_private_key(self, root, for_change, password):
+        xprv = self.get_master_private_key(root, password)
+        if xprv:
+            _, _, _, c, k = deserialize_xkey(xprv)
+            return CKD_priv(k, c, for_change)
+
     def check_password(self, password):
         xpriv = self.get_master_private_key(self.root_name, password)
         xpub = self.master_public_keys[self.root_name]
@@ -1863,13 +2794,10 @@ class BIP44_Wallet(BIP32_HD_Wallet):
     @staticmethod
     def mnemonic_to_seed(mnemonic, passphrase):
         # See BIP39
-        import pbkdf2, hashlib, hmac
         PBKDF2_ROUNDS = 2048
         mnemonic = normalize('NFKD', ' '.join(mnemonic.split()))
         passphrase = BIP44_Wallet.normalize_passphrase(passphrase)
-        return pbkdf2.PBKDF2(mnemonic, 'mnemonic' + passphrase,
-                             iterations = PBKDF2_ROUNDS, macmodule = hmac,
-                             digestmodule = hashlib.sha512).read(64)
+        return pbkdf2_sha512(mnemonic, 'mnemonic' + passphrase, PBKDF2_ROUNDS)
 
     def derive_xkeys(self, root, derivation, password):
         root = self.root_name
@@ -2015,6 +2943,13 @@ class OldWallet(Deterministic_Wallet):
         seed = self.get_seed(password)
         self.accounts['0'].check_seed(seed)
 
+    def unlock(self, password):
+        # checking the password stretches the seed, keep the result
+        context = KeyContext(password)
+        account = self.accounts['0']
+        context.get('0', lambda pw: account.get_master_secret(self, pw))
+        return context
+
     def get_mnemonic(self, password):
         import old_mnemonic
         s = self.get_seed(password)
@@ -145,7 +145,7 @@ class BTChipWallet(BIP44_HW_Wallet):
         # And convert it
         return chr(27 + 4 + (signature[0] & 0x01)) + r + s
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, processes=None):
         if tx.is_complete():
             return
         client = self.get_client()
@@ -60,7 +60,7 @@ class TrezorCompatibleWallet(BIP44_HW_Wallet):
             tx = Transaction(self.network.synchronous_get(request))
         return tx
 
-    def sign_transaction(self, tx, password):
+    def sign_transaction(self, tx, password, processes=None):
         if tx.is_complete():
             return
         # previous transactions used as inputs
@@ -263,8 +263,8 @@ class Wallet_2fa(Multisig_Wallet):
             tx = mk_tx(outputs)
         return tx
 
-    def sign_transaction(self, tx, password):
-        BIP32_Wallet.sign_transaction(self, tx, password)
+    def sign_transaction(self, tx, password, processes=None):
+        BIP32_Wallet.sign_transaction(self, tx, password, processes)
         if tx.is_complete():
             return
         if not self.auth_code:
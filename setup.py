@@ -37,7 +37,7 @@ setup(
     version=version.ELECTRUM_VERSION,
     install_requires=[
         'slowaes>=0.1a1',
-        'ecdsa>=0.9',
+        'ecdsa>=0.15',
         'pbkdf2',
         'requests',
         'qrcode',